@@ -17,6 +17,8 @@ setup(
         'dbfread',
         'utm',
         'pyshp',
+        'ijson',
+        'httpx',
     ],
     packages=find_packages(where='src', ),
     package_dir = {"": "src"},
@@ -4,4 +4,5 @@ from .building import Building
 from .tile import Tile
 from .tiled_image import TiledImage
 from .building_collection import WCBuildingCollection
-from .image_data import ImageDataList
\ No newline at end of file
+from .image_data import ImageDataList
+from .projected_buildings import ProjectedBuildings
\ No newline at end of file
@@ -1,28 +1,23 @@
+import io
 import math
 import random
-from matplotlib import cm
 import numpy as np
-import matplotlib.pyplot as plt
 from rasterio.features import rasterize
-from utils import SurfaceType, create_coco_rle_annotation
-from .building import Building 
+from utils import SurfaceType, create_coco_rle_annotation, save_label
+from .projected_buildings import ProjectedBuildings
 from .tile import Tile
 
 
 class AnnotatedTile(Tile): 
-    export_counter = 0
-
-    def __init__(self, tile:Tile, buildings:list[Building]):
-        super().__init__(tile.parent, tile.tile_image, tile.crop_box, tile.bbox)
+    def __init__(self, tile:Tile, buildings:ProjectedBuildings, building_indices:np.ndarray):
+        super().__init__(tile.parent, tile.crop_box, tile.bbox)
         self.buildings = buildings
+        self.building_indices = building_indices # Buildings intersecting the tile
 
     def get_all_surfaces_of_type(self, surface_type:SurfaceType):
-        surfaces = []
-        for building in self.buildings:
-            surfaces.extend([self.ic_to_tc(surface) for surface in building[surface_type]])
-        return surfaces
+        return [self.ic_to_tc(surface) for surface in self.buildings.get_surfaces(self.building_indices, surface_type)]
 
-    def _create_mask(self, label_walls:bool):
+    def create_mask(self, label_walls:bool):
         tile_size = self.parent.tile_size
         mask = np.zeros(tile_size, dtype=np.uint8)
         walls = self.get_all_surfaces_of_type(SurfaceType.WALL)
@@ -40,8 +35,9 @@ class AnnotatedTile(Tile):
                 rasterize(self.get_all_surfaces_of_type(SurfaceType.ROOF), default_value=1, out_shape=tile_size, out=mask)
         return mask
 
-    def create_coco_semantic_segmentation(self, tile_id:int, label_walls:bool):
-        mask = self._create_mask(label_walls)
+    def create_coco_semantic_segmentation(self, tile_id:int, label_walls:bool, mask:np.ndarray=None):
+        if mask is None:
+            mask = self.create_mask(label_walls)
         if label_walls:
             wall_mask = mask == 2
             roof_mask = mask == 1
@@ -63,16 +59,19 @@ class AnnotatedTile(Tile):
         return tile_info, annotations
 
 
-    def export_tile_with_label(self, label_walls):
-        """Exports the tile as jpg in '/img' and label as png in /label"""
-        mask = self._create_mask(label_walls)
-        percent_buildings = mask.sum() / math.prod(self.parent.tile_size)
-        if  percent_buildings > .05:
-            self.save()
-            plt.imsave(f'{self.parent.output_folder}/label/{repr(self)}.png', mask, cmap=cm.gray)
-            AnnotatedTile.export_counter += 1
-        elif percent_buildings == 0 and AnnotatedTile.export_counter >= 20:
-            # Gives 5 images without any buildings for every 100 with buildings.
-            self.save()
-            plt.imsave(f'{self.parent.output_folder}/label/{repr(self)}.png', mask, cmap=cm.gray)
-            AnnotatedTile.export_counter -= 20
+    def building_coverage(self, mask: np.ndarray) -> float:
+        return mask.sum() / math.prod(self.parent.tile_size)
+
+    def export_tile_with_label(self, mask: np.ndarray, tile_image=None):
+        """Exports the tile as jpg in '/img' and label as png in /label, with the class values as pixel values"""
+        self.save(tile_image)
+        save_label(mask, f'{self.parent.output_folder}/label/{repr(self)}.png')
+
+    def encode_with_label(self, mask: np.ndarray, tile_image=None) -> tuple[bytes, bytes]:
+        """Returns the tile as jpg and the label as png, encoded like export_tile_with_label, for the shard output"""
+        if tile_image is None:
+            tile_image = self.tile_image
+        image, label = io.BytesIO(), io.BytesIO()
+        tile_image.save(image, format='JPEG')
+        save_label(mask, label)
+        return image.getvalue(), label.getvalue()
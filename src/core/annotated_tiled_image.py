@@ -1,12 +1,16 @@
 
 import json
+from itertools import groupby
 from timeit import default_timer
 from PIL import Image
 import numpy as np
+from rasterio.features import rasterize
+import shapely
 from shapely.strtree import STRtree
-from utils import ensure_folder_exists
+from utils import CocoShardWriter, SurfaceType, ensure_folder_exists
 from .annotated_tile import AnnotatedTile
-from .building import Building
+from .building_collection import WCBuildingCollection
+from .projected_buildings import ProjectedBuildings
 from .tiled_image import TiledImage
 
 Image.MAX_IMAGE_PIXELS = 120000000
@@ -14,26 +18,102 @@ Image.MAX_IMAGE_PIXELS = 120000000
 threshold_building_size = 500
 threshold_building_part_size = 1000
 
+# One tile without buildings is exported for every empty_tile_interval tiles with buildings
+empty_tile_interval = 20
+
+
+def get_export_counter_start(image_position: int) -> int:
+    '''
+    The start of the empty tile counter of the image at the given position in the sorted list of exported images.
+    The positions step through all values 0..19 in every 20 consecutive images, like a counter carried over from
+    the previous images would on average, so images with fewer than 20 tiles with buildings also export empty tiles.
+    '''
+    return (image_position * 7) % empty_tile_interval
+
 class AnnotatedTiledImage(TiledImage):
     def __init__(
         self,
-        buildings: np.ndarray,
+        buildings: WCBuildingCollection,
+        building_indices: np.ndarray,
         *args,
-        tile_id_start=0,
-        annotation_id_start=0,
+        image_position=0,
         **kwargs ,
         ):
         super().__init__(*args, **kwargs)
-        self.tile_id_start = tile_id_start
-        self.annotation_id_start = annotation_id_start
+        # Balanced sampling of empty tiles starts from the position of the image in the sorted image list,
+        # so the exported dataset does not depend on the order (or process) the images are handled in.
+        self.export_counter = get_export_counter_start(image_position)
         self.common_tile_info = {
             "height": self.tile_size[0],
             "width": self.tile_size[1],
         }
-        for building in buildings:
-            building.transform_to_image_coordinates(self.wc_to_ic)
-        search_tree = STRtree([b.bbox_ic for b in buildings])
-        self.tiles = [AnnotatedTile(tile, list(buildings.take(search_tree.query(tile.bbox)))) for tile in self]
+        self.buildings = ProjectedBuildings(buildings, building_indices, self.wc_to_ic)
+        self._search_tree = STRtree(self.buildings.bboxes)
+        self.tiles = [AnnotatedTile(tile, self.buildings, self._search_tree.query(tile.bbox)) for tile in self]
+
+    def create_label_band(self, upper: int, lower: int, label_walls: bool) -> np.ndarray:
+        """
+        Rasterizes the walls and roofs of all buildings in the pixel rows upper:lower of the image, over its full width.
+        The label of a tile in these rows is a slice of the band, the same as AnnotatedTile.create_mask (see the check below).
+        """
+        height, width = lower - upper, self.image_width
+        band = np.zeros((height, width), dtype=np.uint8)
+        # The band in image coordinates, and the offsets from image coordinates to the pixels of the band
+        xoff, yoff = width // 2, self.image_height // 2 - upper
+        building_indices = self._search_tree.query(shapely.box(-xoff, yoff - height, width - xoff, yoff))
+        to_band = lambda coordinates: coordinates * (1.0, -1.0) + (xoff, yoff)
+
+        walls = shapely.transform(self.buildings.get_surfaces(building_indices, SurfaceType.WALL), to_band)
+        roofs = shapely.transform(self.buildings.get_surfaces(building_indices, SurfaceType.ROOF), to_band)
+        if len(walls) > 0:
+            rasterize(walls, default_value=2 if label_walls else 1, out_shape=band.shape, out=band)
+        if len(roofs) > 0:
+            rasterize(roofs, default_value=1, out_shape=band.shape, out=band)
+        return band
+
+    def create_tile_masks(self, tiles: list[AnnotatedTile], label_walls: bool):
+        """
+        Yields (tile, label) for the tiles, top-down. The labels are rasterized once per row of tiles with
+        create_label_band, so buildings spanning several tiles in a row are only rasterized once.
+        """
+        band_key = lambda tile: (tile.crop_box[1], tile.crop_box[3])
+        for (upper, lower), band_tiles in groupby(sorted(tiles, key=lambda tile: (tile.crop_box[1], tile.crop_box[0])), key=band_key):
+            band = self.create_label_band(upper, lower, label_walls)
+            for tile in band_tiles:
+                left, _, right, _ = tile.crop_box
+                yield tile, band[:, left:right].copy()
+            del band
+
+    def select_tiles_for_export(self, label_walls) -> dict[AnnotatedTile, np.ndarray]:
+        """Creates the labels of all tiles containing buildings and returns the tiles to export, with their label."""
+        selected = {}
+        tiles = [tile for tile in self.tiles_top_down() if len(tile.building_indices) > 0]
+        for tile, mask in self.create_tile_masks(tiles, label_walls):
+            percent_buildings = tile.building_coverage(mask)
+            if percent_buildings > .05:
+                selected[tile] = mask
+                self.export_counter += 1
+            elif percent_buildings == 0 and self.export_counter >= empty_tile_interval:
+                # Gives 5 images without any buildings for every 100 with buildings.
+                selected[tile] = mask
+                self.export_counter -= empty_tile_interval
+        return selected
+
+    def encode_semantic_segmentation(self, label_walls) -> list[dict]:
+        """
+        Like export_semantic_segmentation with the mask format, but returns the encoded tiles and labels
+        with their metadata instead of writing them, for TileShardWriter.write. The image data is still saved.
+        """
+        self.save_image_data()
+        selected = self.select_tiles_for_export(label_walls)
+        camera_position = (self.image_data.x, self.image_data.y, self.image_data.height)
+        records = []
+        for tile, tile_image in self.read_tile_images(list(selected)):
+            mask = selected.pop(tile)
+            image, label = tile.encode_with_label(mask, tile_image)
+            records.append(dict(key=repr(tile), image=image, label=label, image_name=self.image_data.name,
+                crop_box=tile.crop_box, camera_position=camera_position, building_coverage=tile.building_coverage(mask)))
+        return records
 
     def export_semantic_segmentation(self, annotation_format, label_walls):
         self.save_image_data()
@@ -41,58 +121,56 @@ class AnnotatedTiledImage(TiledImage):
 
         if annotation_format == 'mask':
             ensure_folder_exists(f'{self.output_folder}/label') 
-            for tile in self:
-                if len(tile.buildings) == 0: continue
-                tile.export_tile_with_label(label_walls)
+            # Labels are created from geometry only, and the source image is decoded for the selected tiles only
+            selected = self.select_tiles_for_export(label_walls)
+            for tile, tile_image in self.read_tile_images(list(selected)):
+                tile.export_tile_with_label(selected.pop(tile), tile_image)
 
         elif annotation_format == 'coco':
-            raise NotImplementedError('Only support masks')
-            # ensure_folder_exists(f'{self.output_folder}/annotations')
-            # annotations = []
-            # tiles = []
-            # tile_id = self.tile_id_start
-            # for tile in self:
-            #     if len(tile.buildings) == 0: continue
-            #     tile.save()
-            #     tile_info, annotation = tile.create_coco_semantic_segmentation(tile_id, label_walls)
-            #     annotations.extend(annotation)
-            #     tiles.append(tile_info)
-            #     tile_id +=1
-        
-            # coco = dict(
-            #     info={},
-            #     licenses=[],
-            #     images=tiles,
-            #     annotations=annotations
-            # )
-            # if label_walls:
-            #     coco['categories'] = [{
-            #             "id": 1,
-            #             "name": "Roof",
-            #         },
-            #         {
-            #             "id": 2,
-            #             "name": "Wall"
-            #         },
-            #         {
-            #             "id": 3,
-            #             "name": "Terrace"
-            #         },
-            #         {
-            #             "id": 4,
-            #             "name": "Terrace wall"
-            #         },
-            #         {
-            #             "id": 5,
-            #             "name": "Handrail"
-            #         }
-            #         ]
-            # else:
-            #     coco['categories'] = [{
-            #         "id": 1,
-            #         "name": "Building"
-            #     }]
-
-            # with open(f'{self.output_folder}/annotations/segmentation.json', 'w', encoding='utf-8') as f:
-            #     json.dump(coco, f)
+            # The annotations of the image are streamed to its own shard, and merged with merge_coco_shards
+            # when all images are exported. The image ids are local to the shard.
+            selected = self.select_tiles_for_export(label_walls)
+            with CocoShardWriter(self.output_folder, self.image_data.name) as shard:
+                for tile_id, (tile, tile_image) in enumerate(self.read_tile_images(list(selected)), start=1):
+                    tile.save(tile_image)
+                    shard.write(*tile.create_coco_semantic_segmentation(tile_id, label_walls, selected.pop(tile)))
+
+
+if __name__ == '__main__':
+    # Checks that the tile labels sliced from the row bands are the same as the labels of create_mask,
+    # for square and non-square tile sizes, with random buildings in an image of 3000 x 2000 px
+    from types import SimpleNamespace
+    from core.tile import Tile
+
+    rng = np.random.default_rng(0)
+    corners = rng.uniform((-1500, -1000), (1450, 950), (300, 2))
+    sizes = rng.uniform(5, 50, (300, 2))
+    roofs = shapely.box(*corners.T, *(corners + sizes).T)
+    walls = shapely.box(*corners.T, *(corners + sizes * (1, 0.3)).T)
+    surfaces = np.concatenate((roofs, walls))
+    surface_types = np.repeat((SurfaceType.ROOF.value, SurfaceType.WALL.value), len(roofs))
+    buildings = SimpleNamespace(
+        bboxes=roofs,
+        get_surfaces=lambda indices, surface_type: surfaces[np.concatenate((indices, indices + len(roofs)))][surface_types[np.concatenate((indices, indices + len(roofs)))] == surface_type.value],
+    )
 
+    for tile_size in [(512, 512), (256, 256), (384, 256)]:
+        image = object.__new__(AnnotatedTiledImage)
+        image.tile_size, image.tile_overlap = tile_size, 100
+        image.image_height, image.image_width = 2000, 3000
+        image.buildings = buildings
+        image._search_tree = STRtree(buildings.bboxes)
+        image.exclude_area_polygon, image.include_area_polygon = shapely.Polygon(), None
+        image.image_data = SimpleNamespace(path=None)
+        tile_h, tile_w = tile_size
+        tiles = []
+        for upper in range(0, 2000 - tile_h + 1, 300):
+            for left in range(0, 3000 - tile_w + 1, 400):
+                bbox = shapely.box(left - 1500, 1000 - upper - tile_h, left - 1500 + tile_w, 1000 - upper)
+                tile = Tile(image, (left, upper, left + tile_w, upper + tile_h), bbox)
+                tiles.append(AnnotatedTile(tile, buildings, image._search_tree.query(bbox)))
+        for label_walls in (False, True):
+            masks = dict(image.create_tile_masks(tiles, label_walls))
+            differing = sum(not np.array_equal(masks[tile], tile.create_mask(label_walls)) for tile in tiles)
+            assert differing == 0, f'{differing} of {len(tiles)} tiles differ for tile size {tile_size}'
+        print(f'Tile size {tile_size}: {len(tiles)} tile labels are the same from the bands and create_mask')
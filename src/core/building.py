@@ -6,40 +6,59 @@ import matplotlib.pyplot as plt
 
 import numpy as np
 
+from typing import TYPE_CHECKING
 from utils import SurfaceType
 
+if TYPE_CHECKING:
+    from core.building_collection import WCBuildingCollection
+
 colors = ['blue', 'green', 'red', 'yellow']
 
 
 class Building():
-    def __init__(self, surface_types: list[SurfaceType], surfaces_wc: list[np.ndarray]):
-        self._surface_types = surface_types
-        self._surfaces_wc = surfaces_wc
+    """A view of one building in a WCBuildingCollection. The surfaces are stored in the collection."""
+    def __init__(self, collection: "WCBuildingCollection", index: int):
+        self._collection = collection
+        self.index = index
+        first, last = collection.building_offsets[index:index+2]
+        self._surface_slice = slice(first, last)
         self._surfaces_ic = None
         self._bbox_ic = None
         self._surfaces = None
-        self._has_detected_terraces = False
-
-        # Calculate bbox in world coordinates
-        vertices = np.concatenate(self._surfaces_wc)
-        x_min, y_min = vertices[:,:2].min(axis=0)
-        x_max, y_max = vertices[:,:2].max(axis=0)
-        self.bbox_wc = sg.box(x_min, y_min, x_max, y_max)
 
     def __getitem__(self, surface_type: SurfaceType):
         if self._surfaces is None:
             raise ReferenceError('Building is not transformed to image coordinates yet. Call "transform_to_image_coordinates" first.')
         return self._surfaces[surface_type]
 
+    @property
+    def surface_types(self) -> np.ndarray:
+        """Surface type values of the building. Changes are written to the collection."""
+        return self._collection.surface_types[self._surface_slice]
+
+    @property
+    def surfaces_wc(self) -> list[np.ndarray]:
+        c = self._collection
+        offsets = c.surface_offsets[self._surface_slice.start:self._surface_slice.stop+1]
+        return [c.vertices[c.surface_vertices[start:end]] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    @property
+    def has_detected_terraces(self) -> bool:
+        return self._collection.terraces_detected[self.index]
+
+    @property
+    def bbox_wc(self) -> sg.Polygon:
+        return sg.box(*self._collection.bboxes[self.index])
+
     def transform_to_image_coordinates(self, wc_to_ic):
-        if not self._has_detected_terraces:
+        if not self.has_detected_terraces:
             self.detect_terraces()
-        self._surfaces_ic = [wc_to_ic(s) for s in self._surfaces_wc]
+        self._surfaces_ic = [wc_to_ic(s) for s in self.surfaces_wc]
 
         # Create polygons and sort them based on surface type
         self._surfaces = {surface_type: [] for surface_type in SurfaceType}
-        for surface_type, surface in zip(self._surface_types, self._surfaces_ic):
-            self._surfaces[surface_type].append(sg.Polygon(surface))
+        for surface_type, surface in zip(self.surface_types, self._surfaces_ic):
+            self._surfaces[SurfaceType(surface_type)].append(sg.Polygon(surface))
 
         # Calculate bbox in image coordinates
         vertices = np.concatenate(self._surfaces_ic)
@@ -66,60 +85,8 @@ class Building():
     #     return self._surfaces
 
     def detect_terraces(self):
-        auto_generated_handrails = [] # 75cm high wall surfaces
-        handrail_lower_vertices = [] # To match against terrace surfaces 
-        potential_terraces = [] # Flat roof surfaces
-        confirmed_terraces = [] # Flat "roof surfaces" intersecting with a handrail surface and does not have a proper wall beneath.
-        normal_walls = []
-        potential_terrace_wall = []
-      
-        for i, (vertices, surface_type) in enumerate(zip(self._surfaces_wc, self._surface_types)):            
-            if surface_type == SurfaceType.ROOF:
-                if np.allclose(vertices[:,2], vertices[0,2]): # All vertices have same height
-                    potential_terraces.append(i)
-            elif surface_type == SurfaceType.WALL:
-                surface_height = np.ptp(vertices[:,2])
-                if np.isclose(surface_height, 0.75): # Auto-generated handrails are 75 cm tall
-                    auto_generated_handrails.append(i)
-                    # Saves the two lowest handrail vertices
-                    handrail_lower_vertices.append(vertices[np.argpartition(vertices, 2)[:2]]) 
-                else:
-                    normal_walls.append(vertices)
-                    if surface_height < 2.5:
-                        potential_terrace_wall.append(i)
-
-        if len(auto_generated_handrails) == 0: return
-
-        for i in potential_terraces:
-            # Not a terrace if it doesn't intersect with any auto-generated handrails
-            if not any([np.any(np.all(np.equal(handrail_lower_vertices, vertex), axis=3)) for vertex in self._surfaces_wc[i]]):
-                continue
-
-            for vertex in self._surfaces_wc[i]:
-                # lowest height value for all walls containing a vertex with common xy-coordinates as current potential terrace vertex
-                intersecting_walls_height = [np.min(w[:, 2]) for w in normal_walls if np.any(np.all(np.equal(w[:,:2], vertex[:2]), axis=1))]
-                if not any([vertex[2] - h > 1 for h in intersecting_walls_height]):
-                    # If any of the potential terrace vertices does not have a proper wall beneath it is confirmed as a terrace.
-                    confirmed_terraces.append(i)
-                    break
-                
-        
-        for i in auto_generated_handrails:
-            self._surface_types[i] = SurfaceType.AUTO_GENERATED_HANDRAIL
-            
-        for i in confirmed_terraces:
-            self._surface_types[i] = SurfaceType.TERRACE
-
-        # Detect vertical surfaces only connected to a terrace and not a proper roof.
-        roofs = [roof for roof, surface_type in zip(self._surfaces_wc, self._surface_types) if surface_type == SurfaceType.ROOF]
-        for i in potential_terrace_wall:
-            wall = self._surfaces_wc[i]
-            if not any([np.any(np.all(np.equal(wall[0,:2], roof[:,:2]), axis=1)) for roof in roofs]):
-                self._surface_types[i] = SurfaceType.TERRACE_WALL
-        self._has_detected_terraces = True
-
-                    
-
+        """Classifies the handrails, terraces and terrace walls of the building. See WCBuildingCollection.detect_terraces."""
+        self._collection.detect_terraces(np.array([self.index]))
 
     def draw(self, show=False):
         ax = plt.gca()
@@ -1,11 +1,15 @@
 import json
+import os
+import shutil
 from timeit import default_timer
 from matplotlib import pyplot as plt
 import numpy as np
+import shapely
 from shapely.strtree import STRtree
 import shapely.geometry as sg
-from utils import SurfaceType, get_municipality_border
+from utils import SurfaceType, ensure_folder_exists, get_file_hash, get_municipality_border, ragged_arange
 from core.building import Building
+from core.cityjson_reader import apply_transform, read_city_objects, stream_cityjson, stream_cityjsonseq
 
 def plot_polygon(polygon: sg.Polygon, color='blue'):
     arr = np.array(polygon.exterior.coords)
@@ -13,49 +17,224 @@ def plot_polygon(polygon: sg.Polygon, color='blue'):
 
 
 class WCBuildingCollection():
-    def __init__(self, cityjson_path, municipality):
-        with open(cityjson_path, encoding='utf8') as f:
-            cityjson = json.load(f)
-        self.city_objects = cityjson['CityObjects']
-        self.vertices = np.array(cityjson['vertices'])
+    """
+    The buildings of a CityJSON file, stored column-wise in flat arrays:
+
+        vertices            (n_vertices, 3) world coordinates
+        surface_vertices    Vertex indices of the outer ring of all surfaces, concatenated
+        surface_offsets     Surface i is surface_vertices[surface_offsets[i]:surface_offsets[i+1]]
+        surface_types       SurfaceType value of each surface
+        building_offsets    The surfaces of building b are building_offsets[b]:building_offsets[b+1]
+        bboxes              (n_buildings, 4) bbox of each building in world coordinates (minx, miny, maxx, maxy)
+        convex_hull         Exterior coordinates of the convex hull of all vertices
+
+    Indexing the collection returns a Building, which is a view into these arrays.
+    """
+    columns = ('vertices', 'surface_vertices', 'surface_offsets', 'surface_types', 'building_offsets', 'bboxes', 'convex_hull')
+
+    def __init__(self, cityjson_path, municipality, cache_folder='cache/cityjson', stream=False):
+        """
+        The parsed buildings are cached (after terrace detection) as .npy files in a folder named by the hash
+        of the CityJSON file, and memory-mapped on later runs. Set cache_folder to None to disable the cache.
+
+        With stream=True, or for CityJSONSeq (.jsonl) files, the file is parsed incrementally and only
+        buildings intersecting the municipality border are kept, so files larger than the memory can be read.
+        """
+        stream = stream or cityjson_path.endswith('.jsonl')
+        cache_path = None
+        if cache_folder is not None:
+            cache_key = get_file_hash(cityjson_path)
+            if stream:
+                # Streamed collections only contain the buildings in the municipality
+                cache_key += f'_{municipality["number"]}'
+            cache_path = os.path.join(cache_folder, cache_key)
+
+        if cache_path is not None and os.path.isdir(cache_path):
+            self._load_cache(cache_path)
+        else:
+            t = default_timer()
+            if stream:
+                self._stream_city_objects(cityjson_path, municipality)
+            else:
+                with open(cityjson_path, encoding='utf8') as f:
+                    cityjson = json.load(f)
+                self.vertices = apply_transform(np.array(cityjson['vertices'], dtype=np.float64), cityjson.get('transform'))
+                self._set_columns(read_city_objects(cityjson['CityObjects'].values()))
+                del cityjson
+            print(f'Create buildings took {default_timer()-t} seconds')
+            if cache_path is not None:
+                self.detect_terraces(np.arange(len(self)))
+                self._save_cache(cache_path)
         self.outline = self._find_outline(municipality)
-        self._buildings = None
         self._STRtree = None
 
+    def __len__(self):
+        return len(self.building_offsets) - 1
+
+    def __getitem__(self, index: int) -> Building:
+        return Building(self, index)
+
+    def _load_cache(self, cache_path):
+        for column in self.columns:
+            setattr(self, column, np.load(os.path.join(cache_path, f'{column}.npy'), mmap_mode='r'))
+        # All terraces were detected before the cache was written
+        self.terraces_detected = np.ones(len(self), dtype=bool)
+
+    def _save_cache(self, cache_path):
+        # Written to a temporary folder first, so an interrupted run does not leave a partial cache
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        ensure_folder_exists(tmp_path)
+        for column in self.columns:
+            np.save(os.path.join(tmp_path, f'{column}.npy'), getattr(self, column))
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            # Written by another process in the meantime
+            shutil.rmtree(tmp_path)
+
     def _find_outline(self, municipality):
         municipality_border = get_municipality_border(municipality)
-        cityjson_convex_hull = sg.MultiPoint(self.vertices[:,:2]).convex_hull       
+        cityjson_convex_hull = sg.Polygon(self.convex_hull)
         res = municipality_border.intersection(cityjson_convex_hull)
         return res
 
-    def _get_buildings_and_STRtree(self):
+    def _stream_city_objects(self, cityjson_path, municipality):
+        municipality_border = get_municipality_border(municipality)
+        if cityjson_path.endswith('.jsonl'):
+            self.vertices, columns = stream_cityjsonseq(cityjson_path, municipality_border)
+        else:
+            self.vertices, columns = stream_cityjson(cityjson_path, municipality_border)
+        if len(columns['building_offsets']) <= 1:
+            raise ValueError(f'No buildings in "{cityjson_path}" intersect the border of {municipality["name"]} ({municipality["number"]})')
+        self._set_columns(columns)
+
+    def _set_columns(self, columns: dict[str, np.ndarray]):
+        # The bboxes and the convex hull are not defined without buildings
+        if len(columns['building_offsets']) <= 1:
+            raise ValueError('The CityJSON file contains no buildings')
+        for name, column in columns.items():
+            setattr(self, name, column)
+        self.terraces_detected = np.zeros(len(self), dtype=bool)
+        self.bboxes = self._get_bboxes()
+        self.convex_hull = np.array(sg.MultiPoint(self.vertices[:,:2]).convex_hull.exterior.coords)
+
+    def _get_bboxes(self) -> np.ndarray:
+        # Every building has at least one surface, so the vertex offsets of the buildings are increasing
+        vertex_offsets = self.surface_offsets[self.building_offsets[:-1]]
+        xy = self.vertices[self.surface_vertices, :2]
+        return np.hstack((np.minimum.reduceat(xy, vertex_offsets), np.maximum.reduceat(xy, vertex_offsets)))
+
+    def _get_STRtree(self) -> STRtree:
         if self._STRtree is None:
-            buildings = []
-            t = default_timer()
-            for building in self.city_objects.values():
-                geometry = building["geometry"]
-                if len(geometry) > 1:
-                    print("Length is:", len(geometry))
-                if len(geometry) == 0:
-                    continue
-                
-                boundaries = geometry[0]['boundaries']
-                surface_types = [SurfaceType.parse(surface['type']) for surface in geometry[0]['semantics']['surfaces']]
-                surfaces_wc = [np.take(self.vertices, boundary[0], axis=0) for boundary in boundaries]
-                
-                building = Building(surface_types, surfaces_wc)
-                buildings.append(building)
-            print(f'Create buildings took {default_timer()-t} seconds')
             t = default_timer()
-            self._STRtree = STRtree([b.bbox_wc for b in buildings])
+            self._STRtree = STRtree(shapely.box(*self.bboxes.T))
             print(f'Create STRtree {default_timer()-t} seconds')
-            self._buildings = np.array(buildings)
-        return self._buildings, self._STRtree
+        return self._STRtree
 
     def get_buildings_in_area(self, area: sg.Polygon) -> np.ndarray:
-        buildings, STRtree = self._get_buildings_and_STRtree()
-        return buildings.take(STRtree.query(area))
+        """Returns the indices of the buildings with a bbox intersecting the area."""
+        return self._get_STRtree().query(area)
+
+    def detect_terraces(self, building_indices: np.ndarray):
+        """
+        Classifies the surfaces of the buildings that are not classified yet, all buildings at once:
+
+            Auto-generated handrails    Walls 0.75 m tall
+            Terraces                    Flat roofs sharing a vertex with a handrail, with some vertex that has no
+                                        other wall reaching more than 1 m below it
+            Terrace walls               Walls lower than 2.5 m whose first vertex is not on a remaining roof
+
+        Only buildings with handrails are changed. Vertices are matched by exact coordinates, through ids of the
+        unique coordinates combined with the building, so the matching is done by sorting instead of comparing
+        every pair of surfaces.
+        """
+        building_indices = np.asarray(building_indices, dtype=np.int64)
+        building_indices = building_indices[~self.terraces_detected[building_indices]]
+        if len(building_indices) == 0: return
+        self.terraces_detected[building_indices] = True
+
+        # Surfaces of the buildings, and the positions of their vertices in surface_vertices
+        surface_counts = self.building_offsets[building_indices+1] - self.building_offsets[building_indices]
+        surfaces = ragged_arange(self.building_offsets[building_indices], self.building_offsets[building_indices+1])
+        surface_building = np.repeat(np.arange(len(building_indices)), surface_counts)
+        vertex_counts = self.surface_offsets[surfaces+1] - self.surface_offsets[surfaces]
+        vertex_offsets = np.concatenate(([0], np.cumsum(vertex_counts)))
+        vertex_surface = np.repeat(np.arange(len(surfaces)), vertex_counts)
+        xyz = self.vertices[self.surface_vertices[ragged_arange(self.surface_offsets[surfaces], self.surface_offsets[surfaces+1])]]
+        z = xyz[:,2]
+        types = np.array(self.surface_types[surfaces])
+
+        # Coordinates are only matched within the same building
+        vertex_building = surface_building[vertex_surface]
+        xyz_keys = _get_coordinate_keys(xyz, vertex_building)
+        xy_keys = _get_coordinate_keys(xyz[:,:2], vertex_building)
+
+        first_vertices = vertex_offsets[:-1]
+        z_min = np.minimum.reduceat(z, first_vertices)
+        height = np.maximum.reduceat(z, first_vertices) - z_min
+        is_flat = np.logical_and.reduceat(np.isclose(z, z[first_vertices][vertex_surface]), first_vertices)
+        is_roof = types == SurfaceType.ROOF.value
+        is_wall = types == SurfaceType.WALL.value
+        is_handrail = is_wall & np.isclose(height, 0.75) # Auto-generated handrails are 75 cm tall
+        is_normal_wall = is_wall & ~is_handrail
+
+        has_handrail = np.bincount(surface_building[is_handrail], minlength=len(building_indices)) > 0
+        in_building_with_handrail = has_handrail[surface_building]
+
+        # Potential terraces are flat roofs with a vertex equal to one of the first three vertices of a handrail.
+        # (The lowest vertices were intended, but the original per-building code matched the first three. Kept for identical results.)
+        handrail_keys = xyz_keys[(first_vertices[is_handrail][:,None] + np.arange(3)).ravel()]
+        roof_vertices = np.flatnonzero((is_roof & is_flat & in_building_with_handrail)[vertex_surface])
+        touches_handrail = np.zeros(len(surfaces), dtype=bool)
+        touches_handrail[vertex_surface[roof_vertices[np.isin(xyz_keys[roof_vertices], handrail_keys)]]] = True
+        roof_vertices = roof_vertices[touches_handrail[vertex_surface[roof_vertices]]]
+
+        # A potential terrace is confirmed if any of its vertices has no normal wall, with a vertex at the same xy,
+        # reaching more than 1 m below it. The lowest such wall decides it
+        wall_vertices = np.flatnonzero((is_normal_wall & in_building_with_handrail)[vertex_surface])
+        wall_keys, lowest_wall = _get_min_by_key(xy_keys[wall_vertices], z_min[vertex_surface[wall_vertices]])
+        lowest = _lookup(wall_keys, lowest_wall, xy_keys[roof_vertices], np.inf)
+        is_terrace = np.zeros(len(surfaces), dtype=bool)
+        is_terrace[vertex_surface[roof_vertices[~(z[roof_vertices] - lowest > 1)]]] = True
+
+        # Low walls are terrace walls if their first vertex is not on any of the remaining roofs
+        remaining_roof_keys = xy_keys[((is_roof & ~is_terrace & in_building_with_handrail)[vertex_surface])]
+        potential_terrace_walls = np.flatnonzero(is_normal_wall & (height < 2.5) & in_building_with_handrail)
+        is_terrace_wall = np.zeros(len(surfaces), dtype=bool)
+        is_terrace_wall[potential_terrace_walls[~np.isin(xy_keys[first_vertices[potential_terrace_walls]], remaining_roof_keys)]] = True
+
+        types[is_handrail & in_building_with_handrail] = SurfaceType.AUTO_GENERATED_HANDRAIL.value
+        types[is_terrace] = SurfaceType.TERRACE.value
+        types[is_terrace_wall] = SurfaceType.TERRACE_WALL.value
+        self.surface_types[surfaces] = types
+
+
+def _get_coordinate_keys(coordinates: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    """Integer keys that are equal for equal coordinates (compared like np.equal) in the same group."""
+    order = np.lexsort((*coordinates.T, groups))
+    coordinates, groups = coordinates[order], groups[order]
+    is_new = np.concatenate(([True], np.any(coordinates[1:] != coordinates[:-1], axis=1) | (groups[1:] != groups[:-1])))
+    keys = np.empty(len(order), dtype=np.int64)
+    keys[order] = np.cumsum(is_new)
+    return keys
+
+
+def _get_min_by_key(keys: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The sorted unique keys, and the smallest value of each."""
+    if len(keys) == 0:
+        return keys, values
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.minimum.reduceat(values, starts)
+
 
+def _lookup(keys: np.ndarray, values: np.ndarray, query: np.ndarray, default) -> np.ndarray:
+    """The values of the query keys in the sorted keys, or default where they are missing."""
+    if len(keys) == 0:
+        return np.full(len(query), default)
+    indices = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where(keys[indices] == query, values[indices], default)
 
 if __name__ == '__main__':
     # with open('grimstad.json', encoding='utf8') as f:
@@ -0,0 +1,134 @@
+import json
+import tempfile
+from typing import Iterable
+import numpy as np
+import shapely
+import shapely.geometry as sg
+from utils import SurfaceType
+
+
+def apply_transform(vertices: np.ndarray, transform: dict = None) -> np.ndarray:
+    '''Converts compressed CityJSON vertices (integers with a "transform") to world coordinates.'''
+    if transform is None:
+        return vertices
+    return vertices * np.array(transform['scale']) + np.array(transform['translate'])
+
+
+class BuildingColumns():
+    '''
+    Collects the buildings of CityJSON city objects in the column layout used by WCBuildingCollection.
+    If an area is given, buildings with a bbox not intersecting it are skipped.
+    '''
+    def __init__(self, area: sg.Polygon = None):
+        self.area = area
+        if area is not None:
+            shapely.prepare(area)
+        self.surface_vertices = []
+        self.surface_offsets = [0]
+        self.surface_types = []
+        self.building_offsets = [0]
+
+    def add(self, city_object: dict, vertices: np.ndarray = None, vertex_offset=0):
+        '''
+        Adds a city object. Vertex indices are shifted by vertex_offset. The vertices are only
+        needed (indexed without the offset) when filtering by area.
+        '''
+        geometry = city_object["geometry"]
+        if len(geometry) > 1:
+            print("Length is:", len(geometry))
+        if len(geometry) == 0 or len(geometry[0]['boundaries']) == 0:
+            return
+        boundaries = geometry[0]['boundaries']
+
+        if self.area is not None:
+            xy = vertices[np.concatenate([boundary[0] for boundary in boundaries]), :2]
+            x_min, y_min = xy.min(axis=0)
+            x_max, y_max = xy.max(axis=0)
+            if not self.area.intersects(sg.box(x_min, y_min, x_max, y_max)):
+                return
+
+        for boundary in boundaries:
+            self.surface_vertices.extend(index + vertex_offset for index in boundary[0])
+            self.surface_offsets.append(len(self.surface_vertices))
+        self.surface_types.extend(SurfaceType.parse(surface['type']).value for surface in geometry[0]['semantics']['surfaces'])
+        self.building_offsets.append(len(self.surface_offsets) - 1)
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        return dict(
+            surface_vertices=np.array(self.surface_vertices, dtype=np.int64),
+            surface_offsets=np.array(self.surface_offsets, dtype=np.int64),
+            surface_types=np.array(self.surface_types, dtype=np.uint8),
+            building_offsets=np.array(self.building_offsets, dtype=np.int64),
+        )
+
+
+def read_city_objects(city_objects: Iterable[dict]) -> dict[str, np.ndarray]:
+    columns = BuildingColumns()
+    for city_object in city_objects:
+        columns.add(city_object)
+    return columns.to_arrays()
+
+
+def _compact_vertices(vertices: np.ndarray, columns: dict[str, np.ndarray]) -> np.ndarray:
+    '''Keeps only the vertices referenced by the surfaces, and renumbers the surface vertices.'''
+    used, columns['surface_vertices'] = np.unique(columns['surface_vertices'], return_inverse=True)
+    return np.array(vertices[used], dtype=np.float64)
+
+
+def stream_cityjson(path: str, area: sg.Polygon, chunk_size=1_000_000) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    '''
+    Reads the buildings intersecting the area from a CityJSON file without loading the whole document.
+    The vertices are streamed to a temporary file in a first pass, and the city objects are filtered
+    one at a time in a second pass. Only the vertices of the kept buildings are returned.
+    '''
+    import ijson
+
+    with open(path, 'rb') as f:
+        transform = next(ijson.items(f, 'transform', use_float=True), None)
+
+    with tempfile.TemporaryFile() as vertex_file:
+        n_vertices = 0
+        chunk = []
+        with open(path, 'rb') as f:
+            for vertex in ijson.items(f, 'vertices.item', use_float=True):
+                chunk.append(vertex)
+                if len(chunk) == chunk_size:
+                    apply_transform(np.array(chunk, dtype=np.float64), transform).tofile(vertex_file)
+                    n_vertices += len(chunk)
+                    chunk = []
+        apply_transform(np.array(chunk, dtype=np.float64).reshape(-1, 3), transform).tofile(vertex_file)
+        n_vertices += len(chunk)
+        vertex_file.flush()
+        vertices = np.memmap(vertex_file, dtype=np.float64, mode='r', shape=(n_vertices, 3))
+
+        columns = BuildingColumns(area)
+        with open(path, 'rb') as f:
+            for _, city_object in ijson.kvitems(f, 'CityObjects', use_float=True):
+                columns.add(city_object, vertices)
+        columns = columns.to_arrays()
+        vertices = _compact_vertices(vertices, columns)
+    return vertices, columns
+
+
+def stream_cityjsonseq(path: str, area: sg.Polygon) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    '''
+    Reads the buildings intersecting the area from a CityJSONSeq (.jsonl) file, one feature (line) at the time.
+    The first line holds the metadata and transform, and every following line is a CityJSONFeature with its own vertices.
+    '''
+    vertices = []
+    n_vertices = 0
+    columns = BuildingColumns(area)
+    with open(path, encoding='utf8') as f:
+        transform = json.loads(f.readline()).get('transform')
+        for line in f:
+            if not line.strip(): continue
+            feature = json.loads(line)
+            feature_vertices = apply_transform(np.array(feature['vertices'], dtype=np.float64).reshape(-1, 3), transform)
+            n_buildings = len(columns.building_offsets)
+            for city_object in feature['CityObjects'].values():
+                columns.add(city_object, feature_vertices, n_vertices)
+            if len(columns.building_offsets) > n_buildings:
+                vertices.append(feature_vertices)
+                n_vertices += len(feature_vertices)
+    vertices = np.concatenate(vertices) if len(vertices) > 0 else np.empty((0, 3))
+    return vertices, columns.to_arrays()
@@ -1,14 +1,18 @@
 
+from functools import cached_property
+import hashlib
 import json
-from libs.sosi import read_sos
-from math import radians
+from libs.sosi import read_seamlines
 import os
+import numpy as np
 import shapefile
+import shapely
 import utm
 from shapely.geometry import Polygon
+from shapely.strtree import STRtree
 from shapely.validation import make_valid
 
-from utils import get_image_bbox, Camera
+from utils import Camera, ensure_folder_exists, get_file_hash
 import re
 
 def get_camera(cameras, image_name) -> Camera:
@@ -44,7 +48,7 @@ class ImageDataRecord():
         self.wc_to_ic = cam.get_wc_to_ic_transformer(x, y, height, omega, phi, kappa)
         self.bbox: Polygon = bbox
 
-    @property
+    @cached_property
     def ic_to_wc(self):
         return self.cam.get_ic_to_wc_transformer(self.x, self.y, self.height, self.omega, self.phi, self.kappa)
                         
@@ -80,82 +84,165 @@ class ImageDataRecord():
             }, f)
 
 
+def _read_sos_columns(path) -> dict[str, np.ndarray]:
+    seamlines = read_seamlines(path)
+    return dict(
+        name=seamlines['ImageName'],
+        x=seamlines['CameraX'],
+        y=seamlines['CameraY'],
+        height=seamlines['Alt'],
+        omega=seamlines['Omega'],
+        phi=seamlines['Phi'],
+        kappa=seamlines['Kappa'],
+        bbox_coordinates=seamlines['extent_coordinates'][:, ::-1] / 100, # Coordinates are given in cm. Convert to m.
+        bbox_offsets=seamlines['extent_offsets'],
+    )
+
+
+def _read_shp_columns(path) -> dict[str, np.ndarray]:
+    sf = shapefile.Reader(path)
+    fields = ['imageid', 'easting', 'northing', 'height', 'omega', 'phi', 'kappa']
+    records, points = [], []
+    for shape_record in sf.iterShapeRecords(fields=fields):
+        records.append(list(shape_record.record))
+        points.append(shape_record.shape.points)
+    columns = {field: np.array([record[i] for record in records]) for i, field in enumerate(fields)}
+    lon, lat = np.array([point for shape_points in points for point in shape_points], dtype=np.float64).reshape(-1, 2).T
+    x, y = lon, lat
+    if len(lat) > 0:
+        x, y, *_ = utm.from_latlon(lat, lon, force_zone_number=32, force_zone_letter='N')
+    return dict(
+        name=columns['imageid'].astype(str),
+        x=columns['easting'].astype(np.float64),
+        y=columns['northing'].astype(np.float64),
+        height=columns['height'].astype(np.float64),
+        omega=np.radians(columns['omega'].astype(np.float64)),
+        phi=np.radians(columns['phi'].astype(np.float64)),
+        kappa=np.radians(columns['kappa'].astype(np.float64)),
+        bbox_coordinates=np.column_stack((x, y)),
+        bbox_offsets=np.concatenate(([0], np.cumsum([len(shape_points) for shape_points in points]))).astype(np.int64),
+    )
+
+
+def _get_data_file_hash(path, image_data_format) -> str:
+    if image_data_format == 'sos':
+        return get_file_hash(path)
+    # The data of a shapefile is spread over several files
+    base = os.path.splitext(path)[0] if path.endswith(('.shp', '.dbf')) else path
+    hashes = ''.join(get_file_hash(f'{base}.{extension}') for extension in ('shp', 'dbf'))
+    return hashlib.sha1(hashes.encode()).hexdigest()
+
+
+def read_image_data_columns(path, image_data_format, cache_folder='cache/image_data') -> dict[str, np.ndarray]:
+    '''
+    Reads the image data of all images in a seamline (.sos) or shapefile, as arrays. The arrays are cached
+    in a .npz file named by the hash of the file, so each file is only parsed once.
+    '''
+    readers = {'sos': _read_sos_columns, 'shp': _read_shp_columns}
+    if image_data_format not in readers:
+        raise ValueError(f'"{image_data_format}" is not a valid format. Must be "sos" or "shp"')
+    if cache_folder is None:
+        return readers[image_data_format](path)
+
+    cache_path = os.path.join(cache_folder, f'{_get_data_file_hash(path, image_data_format)}.npz')
+    if os.path.isfile(cache_path):
+        with np.load(cache_path) as cache:
+            return dict(cache)
+
+    columns = readers[image_data_format](path)
+    ensure_folder_exists(cache_folder)
+    # Written to a temporary file first, so an interrupted run does not leave a partial cache
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, cache_path)
+    return columns
+
+
 class ImageDataList():
+    '''
+    The image data records, indexed by image name and by camera, with a search tree over the image bboxes.
+    '''
     def __init__(self, data: list[ImageDataRecord]):
         self._data = data
+        self._index = {record.name: i for i, record in enumerate(data)}
+        self._camera_index: dict[str, list[int]] = {}
+        for i, record in enumerate(data):
+            self._camera_index.setdefault(record.cam.cam_id, []).append(i)
+        self.bboxes = np.array([record.bbox for record in data], dtype=object)
+        self._STRtree = None
+
+    def __getitem__(self, image_id: str) -> ImageDataRecord:
+        index = self._index.get(image_id)
+        return None if index is None else self._data[index]
 
-    def __getitem__(self, image_id: str):
-        return self._data.get(image_id)
+    def __contains__(self, image_id: str):
+        return image_id in self._index
 
     def __len__(self):
         return len(self._data)
     
     def __iter__(self):
         return iter(self._data)
-    
+
+    def get_camera_images(self, cam_id: str) -> list[ImageDataRecord]:
+        return [self._data[i] for i in self._camera_index.get(cam_id, [])]
+
+    def _get_STRtree(self) -> STRtree:
+        if self._STRtree is None:
+            self._STRtree = STRtree(self.bboxes)
+        return self._STRtree
+
+    def query(self, polygon: Polygon, cam_id: str = None, predicate='intersects') -> list[ImageDataRecord]:
+        '''
+        Returns the records where polygon.<predicate>(bbox) is true, e.g. predicate='contains' for the images fully
+        inside the polygon, optionally only for one camera. The records are returned in the order of the list.
+        '''
+        shapely.prepare(polygon)
+        indices = np.sort(self._get_STRtree().query(polygon, predicate=predicate))
+        if cam_id is not None:
+            indices = indices[np.isin(indices, self._camera_index.get(cam_id, []))]
+        return [self._data[i] for i in indices]
+
     @classmethod
-    def from_sos(cls, image_paths, image_data_paths, cameras):
-        available_images = set([os.path.basename(path).split('.')[0] for path in image_paths])
+    def from_files(cls, image_data_format, image_paths, image_data_paths, cameras, cache_folder='cache/image_data'):
+        '''Creates the records of the available images (in image_paths) from seamline (.sos) files or shapefiles.'''
+        # The first path of each image name, as found by the former substring search
+        paths_by_name = {}
+        for path in image_paths:
+            paths_by_name.setdefault(os.path.basename(path).split('.')[0], path)
+
         data = []
-        for path in image_data_paths:
-            seamline = list(read_sos(path).values())[1:-1]
-            image_data = seamline[::2]
-            image_extents = seamline[1::2]
-            for rec, extent in zip(image_data, image_extents):
-                image_name = rec['ImageName']
-                if image_name in available_images:
+        for data_path in image_data_paths:
+            columns = read_image_data_columns(data_path, image_data_format, cache_folder)
+            bbox_offsets = columns['bbox_offsets']
+            indices = np.repeat(np.arange(len(bbox_offsets) - 1), np.diff(bbox_offsets))
+            bboxes = shapely.polygons(shapely.linearrings(columns['bbox_coordinates'], indices=indices))
+            for i, image_name in enumerate(columns['name']):
+                image_name = str(image_name)
+                if image_name in paths_by_name:
                     cam = get_camera(cameras, image_name)
                     if cam is None: continue
-                    image_path = next(filter(lambda path: image_name in path, image_paths), None)
                     data.append(ImageDataRecord(
                         image_name=image_name,
-                        image_path=image_path,
-                        x=float(rec['CameraX']),
-                        y=float(rec['CameraY']),
-                        height=float(rec['Alt']),
-                        omega=float(rec['Omega']),
-                        phi=float(rec['Phi']),
-                        kappa=float(rec['Kappa']),
+                        image_path=paths_by_name[image_name],
+                        x=float(columns['x'][i]),
+                        y=float(columns['y'][i]),
+                        height=float(columns['height'][i]),
+                        omega=float(columns['omega'][i]),
+                        phi=float(columns['phi'][i]),
+                        kappa=float(columns['kappa'][i]),
                         cam=cam,
-                        bbox=get_image_bbox(extent)
+                        bbox=bboxes[i]
                     ))
         return cls(data)
 
-
- 
-    
     @classmethod
-    def from_shp(cls, image_paths, image_data_paths, cameras):
-        available_images = set([os.path.basename(path).split('.')[0] for path in image_paths])
-        data = []
-        for path in image_data_paths:
-            sf = shapefile.Reader(path)
-            
-            for rec in sf.iterRecords(fields=['imageid']):
-                image_name = rec['imageid']
-                if rec['imageid'] in available_images:
-                    cam = get_camera(cameras, image_name)
-                    if cam is None: continue
-                    # if not cam.cam_id == 'cam6L': continue
+    def from_sos(cls, image_paths, image_data_paths, cameras, cache_folder='cache/image_data'):
+        return cls.from_files('sos', image_paths, image_data_paths, cameras, cache_folder)
 
-                    image_path = next(filter(lambda path: image_name in path, image_paths), None)
-                    shapeRec = sf.shapeRecord(rec.oid)
-                    bbox = Polygon([utm.from_latlon(*point[::-1], force_zone_number=32, force_zone_letter='N')[:2] for point in shapeRec.shape.points])
-                    rec = shapeRec.record
-                    data.append(ImageDataRecord(
-                        image_name=image_name,
-                        image_path=image_path,
-                        x=rec['easting'],
-                        y=rec['northing'],
-                        height=rec['height'],
-                        omega=radians(rec['omega']),
-                        phi=radians(rec['phi']),
-                        kappa=radians(rec['kappa']),
-                        cam=cam,
-                        bbox=bbox
-                    ))
-            
-        return cls(data)
+    @classmethod
+    def from_shp(cls, image_paths, image_data_paths, cameras, cache_folder='cache/image_data'):
+        return cls.from_files('shp', image_paths, image_data_paths, cameras, cache_folder)
 
 # if __name__ == '__main__':
     # data = ImageData.from_sos('data/Somlinjefiler/cam4B.sos', 'data/Somlinjefiler/cam5R.sos')
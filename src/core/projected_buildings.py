@@ -0,0 +1,54 @@
+import numpy as np
+import shapely
+from utils import SurfaceType, ragged_arange
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from core.building_collection import WCBuildingCollection
+
+
+class ProjectedBuildings():
+    '''
+    The surfaces of a set of buildings projected to image coordinates.
+
+    All surface vertices are gathered into one array and transformed with a single call to wc_to_ic.
+    The surfaces are kept in a ragged layout: surface i of building b is surfaces[building_offsets[b] + i].
+    '''
+    def __init__(self, buildings: "WCBuildingCollection", building_indices: np.ndarray, wc_to_ic):
+        building_indices = np.asarray(building_indices, dtype=np.int64)
+        buildings.detect_terraces(building_indices)
+
+        first_surface = buildings.building_offsets[building_indices]
+        last_surface = buildings.building_offsets[building_indices+1]
+        surface_indices = ragged_arange(first_surface, last_surface)
+        self.building_offsets = np.concatenate(([0], np.cumsum(last_surface - first_surface)))
+        self.surface_types = buildings.surface_types[surface_indices]
+        if len(surface_indices) == 0:
+            self.surfaces = np.empty(0, dtype=object)
+            self.bboxes = np.empty(0, dtype=object)
+            return
+
+        first_vertex = buildings.surface_offsets[surface_indices]
+        last_vertex = buildings.surface_offsets[surface_indices+1]
+        vertex_counts = last_vertex - first_vertex
+        vertices_wc = buildings.vertices[buildings.surface_vertices[ragged_arange(first_vertex, last_vertex)]]
+        vertices_ic = wc_to_ic(vertices_wc)
+        surface_index = np.repeat(np.arange(len(surface_indices)), vertex_counts)
+        self.surfaces = shapely.polygons(shapely.linearrings(vertices_ic, indices=surface_index))
+
+        # Bbox of each building in image coordinates
+        vertex_offsets = np.concatenate(([0], np.cumsum(vertex_counts)))[self.building_offsets[:-1]]
+        x_min, y_min = np.minimum.reduceat(vertices_ic, vertex_offsets).T
+        x_max, y_max = np.maximum.reduceat(vertices_ic, vertex_offsets).T
+        self.bboxes = shapely.box(x_min, y_min, x_max, y_max)
+
+    def __len__(self):
+        return len(self.building_offsets) - 1
+
+    def get_surfaces(self, building_indices: np.ndarray, surface_type: SurfaceType) -> np.ndarray:
+        '''Returns the surfaces of the given type belonging to the given buildings.'''
+        building_indices = np.asarray(building_indices, dtype=np.int64)
+        surface_indices = ragged_arange(self.building_offsets[building_indices], self.building_offsets[building_indices+1])
+        surface_indices = surface_indices[self.surface_types[surface_indices] == surface_type.value]
+        return self.surfaces[surface_indices]
@@ -1,6 +1,5 @@
 import shapely.geometry as sg
 from shapely.affinity import affine_transform
-from PIL import Image
 
 from typing import TYPE_CHECKING
 
@@ -9,10 +8,9 @@ if TYPE_CHECKING:
 
 
 class Tile():
-    def __init__(self, parent: "TiledImage", tile_image: Image, crop_box: tuple[int, int, int, int], bbox: sg.Polygon):
+    def __init__(self, parent: "TiledImage", crop_box: tuple[int, int, int, int], bbox: sg.Polygon):
         self.parent = parent
         self.crop_box = crop_box # Pixel coordinates (left, upper, right, lower)
-        self.tile_image = tile_image
         self.bbox = bbox # Image coordinates
 
     def __repr__(self):
@@ -24,16 +22,23 @@ class Tile():
         """Returns the bounds of the tile in image coordinates (minx, miny, maxx, maxy)."""
         return self.bbox.bounds
 
+    @property
+    def tile_image(self):
+        """The pixels of the tile. Decoded from the source image on first access."""
+        return self.parent.get_tile_image(self)
+
     def ic_to_tc(self, polygon_ic: sg.Polygon) -> sg.Polygon:
-        xoff, yoff, _, _ = self.bounds
+        # The top of the tile is row 0, for any tile size
+        xoff, _, _, top = self.bounds
         matrix =    (1.0, 0.0, 0.0,
                     0.0, -1.0, 0.0,
                     0.0, 0.0, 1.0,
-                    -xoff, yoff+512, 0.0)
+                    -xoff, top, 0.0)
         return affine_transform(polygon_ic, matrix)
 
 
 
-    def save(self) -> None:
-        self.tile_image.save(f'{self.parent.output_folder}/img/{repr(self)}.jpg')
-        self.tile_image.close()
+    def save(self, tile_image=None) -> None:
+        if tile_image is None:
+            tile_image = self.tile_image
+        tile_image.save(f'{self.parent.output_folder}/img/{repr(self)}.jpg')
@@ -1,8 +1,13 @@
 import json
+from itertools import groupby
 from math import ceil
 from os import path
 from typing import List
+import warnings
 import numpy as np
+import rasterio
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.windows import Window
 import requests
 import shapely.geometry as sg
 from PIL import Image
@@ -11,7 +16,8 @@ from utils import get_image_data, ensure_folder_exists
 from core.tile import Tile
 from utils.get_terrain_heights import get_terrain_heights
 
-
+# The aerial images are plain jpgs, read through rasterio for windowed decoding
+warnings.filterwarnings('ignore', category=NotGeoreferencedWarning)
 
 
 class TiledImage:
@@ -36,6 +42,8 @@ class TiledImage:
             self.tile_size = tile_size
         self.tile_overlap = minimum_tile_overlap
         self.output_folder = output_folder
+        self._source = None
+        self._band = None # (upper, lower, pixels) of the currently decoded row band
         if include_area is not None and self.include_area_polygon is None:
             self.tiles = []
         else:
@@ -99,14 +107,60 @@ class TiledImage:
         ensure_folder_exists(folder)
         self.image_data.save_image_data(folder, self.tile_size)
 
+    def tiles_top_down(self) -> List[Tile]:
+        """Returns the tiles in the order they are stored in the source image, which lets the row bands be decoded in a single pass."""
+        return sorted(self.tiles, key=lambda tile: (tile.crop_box[1], tile.crop_box[0]))
+
+    def _read_window(self, source, left: int, upper: int, right: int, lower: int) -> np.ndarray:
+        pixels = source.read(window=Window(left, upper, right-left, lower-upper))
+        return pixels[0] if pixels.shape[0] == 1 else np.moveaxis(pixels, 0, -1)
+
+    def get_tile_image(self, tile: Tile) -> Image.Image:
+        """
+        Returns the pixels of a tile. The source image is decoded one row band (the rows covered by
+        a row of tiles) at the time, and the previous band is freed when moving on to the next.
+        Request tiles in the order of 'tiles_top_down' to decode each band only once.
+        """
+        left, upper, right, lower = tile.crop_box
+        if self._band is None or self._band[:2] != (upper, lower):
+            self._band = None
+            if self._source is None:
+                self._source = rasterio.open(self.image_data.path)
+            self._band = (upper, lower, self._read_window(self._source, 0, upper, self._source.width, lower))
+        return Image.fromarray(self._band[2][:, left:right])
+
+    def read_tile_images(self, tiles: List[Tile]):
+        """
+        Yields (tile, tile image) for the given tiles, top-down. For each row band only the
+        columns spanned by the requested tiles are read, and bands without tiles are skipped.
+        """
+        band_key = lambda tile: (tile.crop_box[1], tile.crop_box[3])
+        with rasterio.open(self.image_data.path) as source:
+            for (upper, lower), band_tiles in groupby(sorted(tiles, key=lambda tile: (tile.crop_box[1], tile.crop_box[0])), key=band_key):
+                band_tiles = list(band_tiles)
+                left = min(tile.crop_box[0] for tile in band_tiles)
+                right = max(tile.crop_box[2] for tile in band_tiles)
+                pixels = self._read_window(source, left, upper, right, lower)
+                for tile in band_tiles:
+                    yield tile, Image.fromarray(pixels[:, tile.crop_box[0]-left:tile.crop_box[2]-left])
+                del pixels
+
+    def close_image(self) -> None:
+        """Frees the decoded pixels and closes the source image."""
+        self._band = None
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
     def export_image_tiles(self) -> None:
         # Save image data
         self.save_image_data()
 
         # Save tile jpgs
-        ensure_folder_exists(f'{self.output_folder}/images')
-        for tile in self:
+        ensure_folder_exists(f'{self.output_folder}/img')
+        for tile in self.tiles_top_down():
             tile.save()
+        self.close_image()
 
         # self.save_tile_map()
 
@@ -120,29 +174,30 @@ class TiledImage:
     #     return datetime(year, month, day, h, m, s)
 
     def _get_tiles(self) -> List[Tile]:
+        # Only the header is read here. Pixels are decoded when a tile image is requested.
         with Image.open(self.image_data.path) as image: 
             im_h, im_w = image.height, image.width
-            tile_h, tile_w = self.tile_size
-            num_tiles = (ceil(im_h / (tile_h-self.tile_overlap)), ceil(im_w / (tile_w-self.tile_overlap)))
-        
-            step = (ceil((im_h-tile_h) / num_tiles[0]), ceil((im_w-tile_w) / num_tiles[1]))
+        self.image_height, self.image_width = im_h, im_w
+        tile_h, tile_w = self.tile_size
+        num_tiles = (ceil(im_h / (tile_h-self.tile_overlap)), ceil(im_w / (tile_w-self.tile_overlap)))
+    
+        step = (ceil((im_h-tile_h) / num_tiles[0]), ceil((im_w-tile_w) / num_tiles[1]))
 
-            tiles = []
+        tiles = []
 
-            for tile_row in range(num_tiles[0]+1):
-                i = im_h-tile_row*step[0] if tile_row < num_tiles[0] else tile_h
-                y = -i + im_h//2 
-                for tile_col in range(num_tiles[1]+1):
-                    j = tile_col*step[1] if tile_col < num_tiles[1] else im_w-tile_w
-                    x = j-im_w//2
-                    bbox = sg.box(x, y, x+tile_w, y+tile_h) # Bbox in image coordinates
+        for tile_row in range(num_tiles[0]+1):
+            i = im_h-tile_row*step[0] if tile_row < num_tiles[0] else tile_h
+            y = -i + im_h//2 
+            for tile_col in range(num_tiles[1]+1):
+                j = tile_col*step[1] if tile_col < num_tiles[1] else im_w-tile_w
+                x = j-im_w//2
+                bbox = sg.box(x, y, x+tile_w, y+tile_h) # Bbox in image coordinates
 
-                    if bbox.intersects(self.exclude_area_polygon): continue
-                    if self.include_area_polygon is not None and not bbox.intersection(self.include_area_polygon).area / bbox.area > 0.75: continue
+                if bbox.intersects(self.exclude_area_polygon): continue
+                if self.include_area_polygon is not None and not bbox.intersection(self.include_area_polygon).area / bbox.area > 0.75: continue
 
-                    crop_box = (j, i-tile_h, j+tile_w, i) # region in pixel coordinates for PIL.crop
-                    tile_image = image.crop(crop_box)
-                    tiles.append(Tile(self, tile_image, crop_box, bbox))
+                crop_box = (j, i-tile_h, j+tile_w, i) # region in pixel coordinates (left, upper, right, lower)
+                tiles.append(Tile(self, crop_box, bbox))
         return tiles
 
 
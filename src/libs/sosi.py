@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import click
+import numpy as np
 
 @click.command(help='Read Kartverket SOSI-formatted files to python dictionary')
 
@@ -187,5 +188,152 @@ def read_sos(filename, indent_char='.'):
     return data
 
 
+# Fields of the image records in seamline files, and the type they are parsed to
+SEAMLINE_FIELDS = {
+    'ImageName': str,
+    'CameraX': float,
+    'CameraY': float,
+    'Alt': float,
+    'Omega': float,
+    'Phi': float,
+    'Kappa': float,
+}
+
+_ENCODING = 'ISO8859-1'
+_DOT, _NEWLINE, _SPACE = ord('.'), ord('\n'), ord(' ')
+_WHITESPACE = np.frombuffer(b' \t\r\n', dtype=np.uint8)
+_NUMBER_START = np.frombuffer(b'-0123456789', dtype=np.uint8)
+
+
+def _read_numbers(buf, starts, ends, n_tokens):
+    '''Parse the first n_tokens whitespace separated numbers of the lines buf[start:end]
+
+    The bytes of all lines are gathered at once, everything but the wanted tokens
+    is blanked out, and the result is parsed in one call to np.fromstring.
+    '''
+    if len(starts) == 0:
+        return np.empty((0, n_tokens))
+    lengths = ends - starts + 1 # Including the newline, which separates the lines
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    chars = buf[np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)]
+    is_space = np.isin(chars, _WHITESPACE)
+    token_start = ~is_space
+    token_start[1:] &= is_space[:-1]
+    token_number = np.cumsum(token_start)
+    token_number -= np.repeat(token_number[offsets[:-1]] - token_start[offsets[:-1]], lengths)
+    if np.any(token_number[offsets[1:] - 1] < n_tokens):
+        raise ValueError(f'Expected {n_tokens} values on every line')
+    chars = np.where(is_space | (token_number > n_tokens), _SPACE, chars)
+    values = np.fromstring(chars.tobytes(), dtype=np.float64, sep=' ')
+    if len(values) != len(starts) * n_tokens:
+        raise ValueError('Could not parse numbers')
+    return values.reshape(-1, n_tokens)
+
+
+def read_seamlines(filename, fields=SEAMLINE_FIELDS):
+    '''Read the image records and extents of a seamline .sos file to numpy arrays
+
+    The file is read in one go, and the lines are classified by their leading
+    characters with numpy instead of line by line like read_sos. Elements
+    alternate between an image record and its extent (after the header), as in
+    read_sos(filename).values()[1:-1].
+
+    Args
+    ----
+    filename: str
+        full path to .sos file being read
+    fields: dict
+        Record fields to read, mapped to str or float
+
+    Returns
+    -------
+    data: dict
+        One array per field (missing values are '' or nan), and the extents as
+        `extent_coordinates`, the (N, E) coordinates of the first `NØ` of all
+        extents concatenated, where extent i is
+        extent_coordinates[extent_offsets[i]:extent_offsets[i+1]]
+    '''
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    # Terminate the last line, and pad so the first characters of every line can be read
+    buf = np.frombuffer(raw + b'\n\0\0\0\0', dtype=np.uint8)
+    ends = np.flatnonzero(buf == _NEWLINE)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    first_chars = buf[starts[:, None] + np.arange(4)]
+
+    dotted = first_chars[:, 0] == _DOT
+    is_element = dotted & (first_chars[:, 1] != _DOT)
+    is_child = dotted & (first_chars[:, 1] == _DOT) & (first_chars[:, 2] != _DOT)
+    element_index = np.cumsum(is_element) - 1
+    # The first element is the header and the last is `.SLUTT`
+    n = max(is_element.sum() - 2, 0) // 2
+    is_record = (element_index % 2 == 1) & (element_index < 2 * n)
+    is_extent = (element_index % 2 == 0) & (element_index > 0) & (element_index <= 2 * n)
+
+    data = {}
+    child_lines = np.flatnonzero(is_record & is_child)
+    for field, field_type in fields.items():
+        key = np.frombuffer(f'..{field}'.encode(_ENCODING), dtype=np.uint8)
+        # Filtered one character at a time, as most lines differ in the first characters of the key
+        lines = child_lines
+        for i, char in enumerate(key[2:], 2):
+            lines = lines[buf[starts[lines] + i] == char]
+        lines = lines[np.isin(buf[starts[lines] + len(key)], _WHITESPACE[:2])]
+        record_index = element_index[lines] // 2
+        value_starts = starts[lines] + len(key)
+        if field_type is float:
+            column = np.full(n, np.nan)
+            column[record_index] = _read_numbers(buf, value_starts, ends[lines], 1)[:, 0]
+        else:
+            values = [raw[start:end].replace(b':', b'').split() for start, end in zip(value_starts, ends[lines])]
+            values = np.array([value[0].decode(_ENCODING) if value else '' for value in values], dtype=str)
+            column = np.zeros(n, dtype=values.dtype)
+            column[record_index] = values
+        data[field] = column
+
+    # Coordinates of the first `NØ` of each extent, on the lines up to the next line starting with `.`
+    key = np.frombuffer('..NØ'.encode(_ENCODING), dtype=np.uint8)
+    is_no = is_extent & np.all(first_chars == key, axis=1) & np.isin(buf[starts + len(key)], _WHITESPACE)
+    no_lines = np.flatnonzero(is_no)
+    extent_index, first = np.unique(element_index[no_lines] // 2 - 1, return_index=True)
+    extent_of_line = np.full(len(starts), -1)
+    extent_of_line[no_lines[first]] = extent_index
+    last_dotted = np.maximum.accumulate(np.where(dotted, np.arange(len(starts)), 0))
+    lines = np.flatnonzero(~dotted & np.isin(first_chars[:, 0], _NUMBER_START) & is_extent)
+    lines = lines[extent_of_line[last_dotted[lines]] >= 0]
+
+    data['extent_coordinates'] = _read_numbers(buf, starts[lines], ends[lines], 2)
+    counts = np.bincount(extent_of_line[last_dotted[lines]], minlength=n)
+    data['extent_offsets'] = np.concatenate(([0], np.cumsum(counts)))
+    return data
+
+
+@click.command(help='Compare read_seamlines to read_sos on seamline files')
+@click.argument('filenames', nargs=-1, required=True)
+def _benchmark(filenames):
+    from timeit import default_timer
+
+    for filename in filenames:
+        t = default_timer()
+        seamline = list(read_sos(filename).values())[1:-1]
+        t_sos = default_timer() - t
+
+        t = default_timer()
+        data = read_seamlines(filename)
+        t_seamlines = default_timer() - t
+
+        records, extents = seamline[::2], seamline[1::2]
+        n = min(len(records), len(extents))
+        assert n == len(data['ImageName'])
+        for field, field_type in SEAMLINE_FIELDS.items():
+            expected = np.array([field_type(record[field]) for record in records[:n]])
+            assert np.array_equal(expected, data[field]), field
+        expected = [np.array(list(extent.values())[0], dtype=np.float64) for extent in extents[:n]]
+        expected = np.concatenate(expected) if n > 0 else np.empty((0, 2))
+        assert np.array_equal(expected, data['extent_coordinates'])
+        assert np.array_equal(np.cumsum([0] + [len(list(extent.values())[0]) for extent in extents[:n]]), data['extent_offsets'])
+        print(f'{filename}: {n} images, read_sos {t_sos:.3f} s, read_seamlines {t_seamlines:.3f} s ({t_sos/t_seamlines:.1f}x), identical output')
+
+
 if __name__ == '__main__':
-    __read_sos()
+    _benchmark()
@@ -1,6 +1,8 @@
 import json
 import math
+import multiprocessing
 import os
+import traceback
 import click
 from scipy.spatial import Delaunay
 from matplotlib import pyplot as plt
@@ -9,12 +11,14 @@ from shapely.geometry import box
 from tqdm import tqdm
 from config import BUFFER, HEIGHT_PX_OFFSET, HEIGHT_RASTER_SIZE, PX_P_M, RASTER_SIZE, THRESH, TILE_SIZE_M
 from core.image_data import ImageDataList, ImageDataRecord
-from utils import ensure_folder_exists, filter_height_values, get_heights_tiff, Camera, save_corrected_nadir_mask, make_histogram, save_image
+from utils import ElevationStore, ensure_folder_exists, filter_height_values, get_heights_tiff, prefetch_heights_tiffs, raster_cache, Camera, ResultMosaic, save_corrected_nadir_mask, project_to_ground, make_histogram, save_image
 from PIL import Image, ImageTransform
 from scipy.ndimage import median_filter, gaussian_filter
 from scipy.interpolate import LinearNDInterpolator
 import rasterio
 from rasterio.transform import from_bounds
+from rasterio.windows import Window
+import rasterio.shutil
 
 import rasterio
 from rasterio.transform import  rowcol
@@ -32,6 +36,33 @@ from utils.convolution import smooth
 
 
 
+# State shared with the worker processes. The pool is forked after this is set, so the
+# image data (and the cached transformers of its records) are inherited instead of pickled per task.
+_shared = {}
+
+# Thresholds of the combined score in the compiled results
+COMBINED_THRESHOLDS = (1.5, 1.75, 2, 2.25)
+
+def _init_worker():
+    # The open rasters of the store must not be shared with the parent process
+    if _shared['dsm'] is not None:
+        _shared['dsm'].reopen()
+    # The statistics inherited from the parent process are already counted there
+    raster_cache.take_stats()
+
+def analyze_tile_task(tile_dir: str) -> tuple[str, str, dict]:
+    '''
+    Analyzes the tile, and returns the tile folder with the traceback if it failed, so one bad tile does not stop the run.
+    The raster cache statistics of the task are also returned, so the statistics of all workers can be added up.
+    '''
+    try:
+        analyze_tile(tile_dir, _shared['image_data'], _shared['dsm'], _shared['mosaic'])
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return tile_dir, error, raster_cache.take_stats()
+
+
 def interpolate_heights(height_values, building_pixels, height, width):
     z_grid = np.zeros((height, width))
 
@@ -43,7 +74,12 @@ def interpolate_heights(height_values, building_pixels, height, width):
 
     return z_grid
 
-def analyze_tile(tile_dir: str, image_data: list[ImageDataRecord]):
+def get_tile_area(tile_dir: str):
+    with open(os.path.join(tile_dir, 'info.json'), 'r') as f:
+        tile_info = json.load(f)
+    return box(tile_info['x'], tile_info['y'], tile_info['x'] + TILE_SIZE_M, tile_info['y'] + TILE_SIZE_M)
+
+def analyze_tile(tile_dir: str, image_data: ImageDataList, dsm: ElevationStore = None, mosaic: ResultMosaic = None):
     mask_dir = os.path.join(tile_dir, 'masks')
     mask_paths = [os.path.join(mask_dir,mask) for mask in os.listdir(mask_dir)]
     masks = [plt.imread(mask) for mask in mask_paths]
@@ -70,7 +106,7 @@ def analyze_tile(tile_dir: str, image_data: list[ImageDataRecord]):
     aoi = box(tile_x, tile_y, tile_maxx, tile_maxy)
     
 
-    heights_tiff = get_heights_tiff(aoi.buffer(BUFFER), tile_size=HEIGHT_RASTER_SIZE)
+    heights_tiff = get_heights_tiff(aoi.buffer(BUFFER), tile_size=HEIGHT_RASTER_SIZE, store=dsm)
     heights = heights_tiff.read(1)
 
     # # Save image of heights just because
@@ -87,6 +123,7 @@ def analyze_tile(tile_dir: str, image_data: list[ImageDataRecord]):
     
 
     result = np.zeros((RASTER_SIZE, RASTER_SIZE))
+    nadir_prob = np.zeros((RASTER_SIZE, RASTER_SIZE))
     # count = np.zeros((RASTER_SIZE,RASTER_SIZE), dtype=np.uint8)
 
     transform = from_bounds(tile_x, tile_y, tile_maxx, tile_maxy, RASTER_SIZE, RASTER_SIZE)
@@ -98,7 +135,7 @@ def analyze_tile(tile_dir: str, image_data: list[ImageDataRecord]):
     image_info:dict = tile_info['image_info']
     for cam_id, info in image_info.items():
         im_name = info['image_name']
-        im_data = next(x for x in image_data if x.name == im_name)
+        im_data = image_data[im_name]
 
         cropbox_size = info['cropbox_size']
         dx = info['dx']
@@ -111,15 +148,17 @@ def analyze_tile(tile_dir: str, image_data: list[ImageDataRecord]):
         mask_im = Image.open(os.path.join(mask_dir, f'{im_name}.png')).resize((cropbox_size, cropbox_size))
         
         if cam_id == 'Cam0N':
-            nadir_result = save_corrected_nadir_mask(tile_x, tile_y, result_dir, heights, heights_tiff.transform, im_data, minx, miny, mask_im, mask_h)
-            nadir_result[nadir_result < THRESH] = 0
+            nadir_prob = save_corrected_nadir_mask(tile_x, tile_y, result_dir, heights, heights_tiff.transform, im_data, minx, miny, mask_im, mask_h)
+            nadir_result = np.where(nadir_prob < THRESH, 0, nadir_prob)
             result += nadir_result**2
         else:
             mask = np.array(mask_im.crop(cropbox))
             mask = mask / 255
             
-            if not np.any(mask > THRESH): continue
-            building_pixels = np.argwhere(mask > THRESH)
+            # The mask is thresholded once, for the building pixels and for the lookup of the points below
+            is_building = mask > THRESH
+            if not is_building.any(): continue
+            building_pixels = np.argwhere(is_building)
 
             laser_data_ic = im_data.wc_to_ic(xyz)
             laser_data_tc = np.zeros((HEIGHT_RASTER_SIZE*HEIGHT_RASTER_SIZE, 3), dtype=np.float32)
@@ -127,9 +166,12 @@ def analyze_tile(tile_dir: str, image_data: list[ImageDataRecord]):
             laser_data_tc[:,1] = laser_data_ic[:,0] - minx
             laser_data_tc[:,2] = xyz[:,2]
 
-            x_mask = np.equal.outer(laser_data_tc[:,0].astype(np.int16), building_pixels[:, 0])
-            y_mask = np.equal.outer(laser_data_tc[:,1].astype(np.int16), building_pixels[:, 1])
-            selected_indices = np.where(np.logical_and(x_mask, y_mask).any(axis=1))[0]
+            # Points on a building pixel, looked up in the thresholded mask by their truncated coordinates
+            point_rows = laser_data_tc[:,0].astype(np.int16)
+            point_cols = laser_data_tc[:,1].astype(np.int16)
+            in_mask = (point_rows >= 0) & (point_rows < is_building.shape[0]) & (point_cols >= 0) & (point_cols < is_building.shape[1])
+            selected_indices = np.flatnonzero(in_mask)
+            selected_indices = selected_indices[is_building[point_rows[selected_indices], point_cols[selected_indices]]]
 
             # Select points using the indices
             laser_data_tc = laser_data_tc[selected_indices]
@@ -150,14 +192,7 @@ def analyze_tile(tile_dir: str, image_data: list[ImageDataRecord]):
             lng, lat = im_data.ic_to_wc(x, y, Z) 
             
 
-            result_rows, result_cols = rowcol(transform, lng, lat)
-            tmp_result = np.zeros((RASTER_SIZE, RASTER_SIZE))
-            for r, c, score  in zip(result_rows, result_cols, mask[rows, cols]):
-                if r < 0 or r > RASTER_SIZE-1 or c < 0 or c > RASTER_SIZE-1:
-                    continue
-                else:
-                    tmp_result[r,c] = max(tmp_result[r,c], score)
-                    # count[r,c] += 1
+            tmp_result = project_to_ground(lng, lat, mask[rows, cols], transform, (RASTER_SIZE, RASTER_SIZE))
             result += tmp_result
             # tmp_result[tmp_result>5] = 5.0
             save_image(tmp_result, f'{result_dir}/result_{cam_id}.png')
@@ -168,97 +203,87 @@ def analyze_tile(tile_dir: str, image_data: list[ImageDataRecord]):
     # result_smooth = median_filter(result, 5)
     result_smooth = gaussian_filter(result, 5)
     # result_smooth = smooth(result, count)
-    result_sharp_5 = result_smooth >= 1.5
-    result_sharp_75 = result_smooth >= 1.75
-    result_sharp_2 = result_smooth >= 2
-    result_sharp_2_25 = result_smooth >= 2.25
     
     # result[result>5] = 5
     save_image(result, f'{result_dir}/result.png')
     save_image(result_smooth, f'{result_dir}/result_smooth.png')
-    save_image(result_sharp_5, f'{result_dir}/result_sharp_1_5.png', mode='1')
-    save_image(result_sharp_75, f'{result_dir}/result_sharp_1_75.png', mode='1')
-    save_image(result_sharp_2, f'{result_dir}/result_sharp_2.png', mode='1')
-    save_image(result_sharp_2_25, f'{result_dir}/result_sharp_2_25.png', mode='1')
-
-
-def compile_tiles(analysis_folder):
+    # The thresholded results are derived from the mosaic in compile_tiles
+    if mosaic is not None:
+        mosaic.write_tile(tile_x, tile_y, combined=result_smooth, nadir=nadir_prob)
+
+
+def compile_tiles(analysis_folder, png=True, band_height=1024):
+    '''
+    Writes the combined score and nadir probability of the result mosaic as GeoTIFFs, and the thresholded results
+    as 1-bit GeoTIFFs. The mosaic is read in bands of rows, so only one band of each output is in memory at the time.
+    With png=True, the outputs are also saved as PNGs. GDAL writes them row by row from the GeoTIFFs, and the float
+    outputs are first scaled to 0-255 by their maximum in temporary 8-bit GeoTIFFs, like save_image does.
+    '''
     output_folder = os.path.join(analysis_folder, 'compiled')
-    ensure_folder_exists(output_folder)
-    tile_xs = []
-    tile_ys = []
-    for tile_folder in [f.name for f in os.scandir(analysis_folder) if f.is_dir() and '_' in f.name]:
-        x, y = tile_folder.split('_')
-        tile_xs.append(int(x))
-        tile_ys.append(int(y))
-    tile_minx, tile_maxx = min(tile_xs), max(tile_xs)
-    tile_miny, tile_maxy = min(tile_ys), max(tile_ys)
-    area_width = tile_maxx - tile_minx + TILE_SIZE_M
-    area_height = tile_maxy - tile_miny + TILE_SIZE_M
-
-    nadir_result = np.zeros((area_height*PX_P_M, area_width*PX_P_M), dtype=np.uint8)
-    result = np.zeros_like(nadir_result)
-
-    nadir_result_sharp = np.zeros_like(nadir_result, dtype=bool)
-    result_1_5 = np.zeros_like(nadir_result, dtype=bool)
-    result_1_75 = np.zeros_like(nadir_result, dtype=bool)
-    result_2 = np.zeros_like(nadir_result, dtype=bool)
-    result_2_25 = np.zeros_like(nadir_result, dtype=bool)
-
-
-    for tile_folder in tqdm([f.name for f in os.scandir(analysis_folder) if f.is_dir and '_' in f.name]):
-        if not os.path.exists(os.path.join(analysis_folder, tile_folder, 'results')): continue
-
-        x, y = tile_folder.split('_')
-        x = (int(x) - tile_minx) * PX_P_M
-        y = (tile_maxy - int(y)) * PX_P_M
-
-        nadir_im = np.array(Image.open(os.path.join(analysis_folder, tile_folder, 'results', 'nadir_result.png')), dtype=np.uint8)
-        nadir_result[y:y+RASTER_SIZE, x:x+RASTER_SIZE] = nadir_im
-
-        nadir_sharp = np.array(Image.open(os.path.join(analysis_folder, tile_folder, 'results', 'nadir_result_sharp.png')), dtype=bool)
-        nadir_result_sharp[y:y+RASTER_SIZE, x:x+RASTER_SIZE] = nadir_sharp
-
-        combined_im = np.array(Image.open(os.path.join(analysis_folder, tile_folder, 'results', 'result_smooth.png')), dtype=np.uint8)
-        result[y:y+RASTER_SIZE, x:x+RASTER_SIZE] = combined_im
-
-        combined_im_1_5 = np.array(Image.open(os.path.join(analysis_folder, tile_folder, 'results', 'result_sharp_1_5.png')), dtype=bool)
-        result_1_5[y:y+RASTER_SIZE, x:x+RASTER_SIZE] = combined_im_1_5
-  
-        combined_im_1_75 = np.array(Image.open(os.path.join(analysis_folder, tile_folder, 'results', 'result_sharp_1_75.png')), dtype=bool)
-        result_1_75[y:y+RASTER_SIZE, x:x+RASTER_SIZE] = combined_im_1_75
-
-        combined_im_2 = np.array(Image.open(os.path.join(analysis_folder, tile_folder, 'results', 'result_sharp_2.png')), dtype=bool)
-        result_2[y:y+RASTER_SIZE, x:x+RASTER_SIZE] = combined_im_2
-
-        combined_im_2_25 = np.array(Image.open(os.path.join(analysis_folder, tile_folder, 'results', 'result_sharp_2_25.png')), dtype=bool)
-        result_2_25[y:y+RASTER_SIZE, x:x+RASTER_SIZE] = combined_im_2_25
-
-    save_image(nadir_result, f'{output_folder}/nadir.png')
-    save_image(result, f'{output_folder}/combined.png')
-    save_image(nadir_result_sharp, f'{output_folder}/nadir_sharp.png', mode='1')
-    save_image(result_1_5, f'{output_folder}/combined_1_5.png', mode='1')
-    save_image(result_1_75, f'{output_folder}/combined_1_75.png', mode='1')
-    save_image(result_2, f'{output_folder}/combined_2.png', mode='1')
-    save_image(result_2_25, f'{output_folder}/combined_2_25.png', mode='1')
-
-    transform = from_bounds(tile_minx, tile_miny, tile_maxx, tile_maxy, area_width, area_height)
-
-    combined_prob = (result / 255).astype(np.float32)
-    nadir_prob = (nadir_result / 255).astype(np.float32)
-
-    with rasterio.open(f'{output_folder}/combined.tiff', 'w', driver='GTiff', height=area_height*PX_P_M, width=area_width*PX_P_M, count=1, dtype=rasterio.float32,
-                   crs='EPSG:25832', transform=transform) as dst:
-        dst.write(combined_prob, 1)
-
-    with rasterio.open(f'{output_folder}/nadir.tiff', 'w', driver='GTiff', height=area_height*PX_P_M, width=area_width*PX_P_M, count=1, dtype=rasterio.float32,
-                   crs='EPSG:25832', transform=transform) as dst:
-        dst.write(nadir_prob, 1)
+    mosaic = ResultMosaic.open(output_folder)
+    combined = mosaic.get_band('combined')
+    nadir = mosaic.get_band('nadir')
+    height, width = combined.shape
+    bands = [slice(row, min(row + band_height, height)) for row in range(0, height, band_height)]
+
+    # Output name: (dtype, function of the combined score and nadir probability)
+    outputs = {
+        'combined': (rasterio.float32, lambda combined, nadir: combined),
+        'nadir': (rasterio.float32, lambda combined, nadir: nadir),
+        'nadir_sharp': (rasterio.uint8, lambda combined, nadir: nadir > 0.5),
+    }
+    for threshold in COMBINED_THRESHOLDS:
+        outputs[f'combined_{format(threshold, "g").replace(".", "_")}'] = (rasterio.uint8, lambda combined, nadir, threshold=threshold: combined >= threshold)
+
+    # The float outputs are scaled by their maximum in the PNGs
+    png_maxima = {}
+    if png:
+        png_maxima = {'combined': max(combined[rows].max() for rows in bands), 'nadir': max(nadir[rows].max() for rows in bands)}
+        for name, maximum in list(png_maxima.items()):
+            if maximum <= 0:
+                # Nothing to scale, e.g. when all tiles failed or have no buildings
+                print(f'No {name} results above 0, the {name} PNG is not written')
+                del png_maxima[name]
+
+    profile = dict(driver='GTiff', height=height, width=width, count=1, crs='EPSG:25832', transform=mosaic.transform,
+                   tiled=True, blockxsize=256, blockysize=256, compress='deflate')
+    datasets = {}
+    try:
+        for name, (dtype, _) in outputs.items():
+            nbits = {'nbits': 1} if dtype == rasterio.uint8 else {}
+            datasets[name] = rasterio.open(f'{output_folder}/{name}.tiff', 'w', dtype=dtype, **nbits, **profile)
+        for name in png_maxima:
+            datasets[f'{name}_png'] = rasterio.open(f'{output_folder}/{name}_png.tiff', 'w', dtype=rasterio.uint8, **profile)
+        for rows in tqdm(bands):
+            window = Window.from_slices(rows, (0, width))
+            combined_band, nadir_band = combined[rows], nadir[rows]
+            for name, (dtype, get_output) in outputs.items():
+                output = get_output(combined_band, nadir_band)
+                datasets[name].write(output.astype(dtype), 1, window=window)
+                if name in png_maxima:
+                    datasets[f'{name}_png'].write(((output / png_maxima[name]) * 255).astype(np.uint8), 1, window=window)
+    finally:
+        for dataset in datasets.values():
+            dataset.close()
+
+    if png:
+        # The PNGs are not georeferenced, so no .aux.xml files are written next to them
+        with rasterio.Env(GDAL_PAM_ENABLED='NO'):
+            for name, (dtype, _) in outputs.items():
+                if dtype != rasterio.uint8 and name not in png_maxima: continue
+                if name in png_maxima:
+                    rasterio.shutil.copy(f'{output_folder}/{name}_png.tiff', f'{output_folder}/{name}.png', driver='PNG')
+                    os.remove(f'{output_folder}/{name}_png.tiff')
+                else:
+                    rasterio.shutil.copy(f'{output_folder}/{name}.tiff', f'{output_folder}/{name}.png', driver='PNG', NBITS=1)
 
 
 @click.command()
 @click.argument('config')
-def analyze_predictions(config):
+@click.option('-w', '--workers', default=1, help='Number of processes used to analyze tiles')
+@click.option('--compile-only', is_flag=True, help='Only compile the results of already analyzed tiles')
+@click.option('--no-png', is_flag=True, help='Only write the compiled results as GeoTIFFs')
+def analyze_predictions(config, workers, compile_only, no_png):
     #### Parameters ####
     # config = 'config/analysis/grimstad.json'
     # config = 'config/analysis/lindesnes.json'
@@ -268,8 +293,9 @@ def analyze_predictions(config):
 
     analysis_folder = config['folder']
 
-    compile_tiles(analysis_folder)
-    exit()
+    if compile_only:
+        compile_tiles(analysis_folder, png=not no_png)
+        return
 
     cameras = {camera_info['cam_id']: Camera(camera_info) for camera_info in config['cameras']}
 
@@ -280,21 +306,42 @@ def analyze_predictions(config):
     image_paths = [os.path.join(image_folder, file[:-4]) for _, _, files in os.walk(analysis_folder) for file in files]
     
     image_data_paths = config['image_data']
-    image_data_format = config['image_data_format']
-    if image_data_format == 'sos':
-        image_data = ImageDataList.from_sos(image_paths, image_data_paths, cameras)
-    elif image_data_format == 'shp':
-        image_data = ImageDataList.from_shp(image_paths, image_data_paths, cameras)
-    else:
-        raise ValueError(f'"{image_data_format}" is not a valid format. Must be "sos" or "shp"')
-
-    
-    for tile_folder in tqdm([f.path for f in os.scandir(analysis_folder) if f.is_dir()]):
-        
-        analyze_tile(tile_folder, image_data)
+    image_data = ImageDataList.from_files(config['image_data_format'], image_paths, image_data_paths, cameras)
+    # Local DSM tiles, if available. Otherwise the heights are requested from the WCS
+    dsm = ElevationStore(config['dsm'], config.get('elevation_fallback', True)) if 'dsm' in config else None
+
+    tile_folders = sorted(f.path for f in os.scandir(analysis_folder) if f.is_dir() and '_' in f.name)
+    # The heights of all tiles are downloaded concurrently before the tiles are analyzed
+    prefetch_heights_tiffs([get_tile_area(tile_folder).buffer(BUFFER) for tile_folder in tile_folders], tile_size=HEIGHT_RASTER_SIZE, store=dsm)
+
+    # The tiles write their results to the mosaic. It is created before forking, so the workers share the mapping
+    tile_names = [os.path.basename(tile_folder).split('_') for tile_folder in tile_folders]
+    mosaic = ResultMosaic.create(os.path.join(analysis_folder, 'compiled'), [int(x) for x, _ in tile_names], [int(y) for _, y in tile_names])
+
+    _shared.update(image_data=image_data, dsm=dsm, mosaic=mosaic)
+    failed = []
+    pool = multiprocessing.get_context('fork').Pool(workers, initializer=_init_worker) if workers > 1 else None
+    # Results are reported in the order of the tiles
+    results = pool.imap(analyze_tile_task, tile_folders) if pool is not None else map(analyze_tile_task, tile_folders)
+    for tile_folder, error, cache_stats in tqdm(results, total=len(tile_folders)):
+        raster_cache.add_stats(cache_stats)
+        if error is not None:
+            tqdm.write(f'Failed to analyze {tile_folder}:\n{error}')
+            failed.append(tile_folder)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print(raster_cache)
+    mosaic.flush()
+    _shared.clear()
+
+    if len(failed) > 0:
+        print(f'{len(failed)} of {len(tile_folders)} tiles failed:')
+        for tile_folder in failed:
+            print(f'  {tile_folder}')
 
     print('Compiling...')
-    compile_tiles(analysis_folder)
+    compile_tiles(analysis_folder, png=not no_png)
 
 
 
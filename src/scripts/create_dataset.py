@@ -1,19 +1,43 @@
 import gc
 import json
+import multiprocessing
 import os
 import click
 from tqdm import tqdm
 
 from core import AnnotatedTiledImage, WCBuildingCollection, ImageDataList
-from utils import Camera
+from utils import Camera, TileShardWriter, clear_coco_shards, merge_coco_shards
 from PIL import Image
 from shapely.geometry import shape
 
 Image.MAX_IMAGE_PIXELS = 287944704
 
+# State shared with the worker processes. The pool is forked after this is set, so the
+# (read-only) building collection and image data are inherited instead of pickled per task.
+_shared = {}
+
+def export_image(index: int) -> str:
+    image = _shared['images'][index]
+    buildings = _shared['buildings']
+    buildings_in_image = buildings.get_buildings_in_area(image.bbox)
+    # The position of the image among the images of all areas decides its empty tile sampling
+    image_position = _shared['first_image_position'] + index
+    tiled_image = AnnotatedTiledImage(buildings, buildings_in_image, image, image_position=image_position, **_shared['tiled_image_args'])
+    if _shared['output_format'] == 'shards':
+        # The encoded tiles are returned, and written to the shards by the main process
+        result = tiled_image.encode_semantic_segmentation(_shared['label_walls'])
+    else:
+        tiled_image.export_semantic_segmentation(_shared['annotation_format'], _shared['label_walls'])
+        result = []
+    del tiled_image
+    del buildings_in_image
+    gc.collect()
+    return result
+
 @click.command()
 @click.option('-c', '--config', default='data/config/lindesnes.json')
-def create_dataset(config):
+@click.option('-w', '--workers', default=1, help='Number of processes used to export images')
+def create_dataset(config, workers):
     with open(config, encoding='utf8') as f:
         config = json.load(f)
 
@@ -22,34 +46,63 @@ def create_dataset(config):
     
     image_data_paths = config['image_data']
 
-    image_data_format = config['image_data_format']
-    if image_data_format == 'sos':
-        image_data = ImageDataList.from_sos(image_paths, image_data_paths, cameras)
-    elif image_data_format == 'shp':
-        image_data = ImageDataList.from_shp(image_paths, image_data_paths, cameras)
-    else:
-        raise ValueError(f'"{image_data_format}" is not a valid format. Must be "sos" or "shp"')
+    image_data = ImageDataList.from_files(config['image_data_format'], image_paths, image_data_paths, cameras)
+
+    # 'files' writes every tile and label to img/ and label/, 'shards' packs them into tar shards with an index
+    output_format = config.get('output_format', 'files')
+    if output_format == 'shards' and config['annotation_format'] != 'mask':
+        raise ValueError('The shard output format only supports the mask annotation format')
+    shard_writer = TileShardWriter(config['output_folder']) if output_format == 'shards' else None
+    if config['annotation_format'] == 'coco':
+        # Only the COCO shards of this run are merged
+        clear_coco_shards(config['output_folder'])
     
+    first_image_position = 0
     for area in config['areas']:
         print('Creating building collection')
-        buildings = WCBuildingCollection(area['cityjson'], area['municipality'])
+        # Large .json exports can be parsed incrementally, see WCBuildingCollection
+        buildings = WCBuildingCollection(area['cityjson'], area['municipality'], stream=config.get('stream_cityjson', False))
         area_outline = buildings.outline
         print('Complete')
         
         exclude_area = area['exclude'] if "exclude" in area else None
         include_area = area['include'] if 'include' in area else None
-        i = 0
-        for image in tqdm(image_data):
-            if  image.is_image_in_area(area_outline):
-                buildings_in_image = buildings.get_buildings_in_area(image.bbox)
-                tiled_image = AnnotatedTiledImage(buildings_in_image, image, output_folder=config['output_folder'], tile_size=config['tile_size'], exclude_area=exclude_area, include_area=include_area)
-                annotation_format = config['annotation_format']
-                label_walls = config['label_walls']
-                tiled_image.export_semantic_segmentation(annotation_format, label_walls)
-                del tiled_image
-                del buildings_in_image
-                i+=1
-                gc.collect()   
+        # Images fully inside the area are kept without computing the overlap
+        contained = set(image.name for image in image_data.query(area_outline, predicate='contains'))
+        images = [image for image in image_data.query(area_outline) if image.name in contained or image.is_image_in_area(area_outline)]
+        images.sort(key=lambda image: image.name)
+
+        _shared.update(
+            images=images,
+            buildings=buildings,
+            first_image_position=first_image_position,
+            annotation_format=config['annotation_format'],
+            output_format=output_format,
+            label_walls=config['label_walls'],
+            tiled_image_args=dict(output_folder=config['output_folder'], tile_size=config['tile_size'], exclude_area=exclude_area, include_area=include_area),
+        )
+        if workers > 1:
+            # Build the search tree before forking, so it is not rebuilt in every worker
+            buildings._get_STRtree()
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                for records in tqdm(pool.imap_unordered(export_image, range(len(images))), total=len(images)):
+                    for record in records:
+                        shard_writer.write(**record)
+        else:
+            for i in tqdm(range(len(images))):
+                for record in export_image(i):
+                    shard_writer.write(**record)
+        _shared.clear()
+        first_image_position += len(images)
+
+    if shard_writer is not None:
+        print(f'Wrote {shard_writer.close()} tiles to shards')
+
+    if config['annotation_format'] == 'coco':
+        # Each image is exported to its own shard, so the workers never share a file or an id counter
+        print('Merging COCO annotations')
+        n_images, n_annotations = merge_coco_shards(config['output_folder'], config['label_walls'])
+        print(f'Merged {n_images} images and {n_annotations} annotations')
 
 if __name__ == '__main__':
     create_dataset()
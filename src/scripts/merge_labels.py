@@ -1,17 +1,16 @@
 import glob
 from os import path
 import click
-from matplotlib import pyplot as plt
 
 from tqdm import tqdm
+from utils import read_label, save_label
 
 @click.command()
 @click.argument('label_folder')
 def merge_labels(label_folder):
     for im_path in tqdm(glob.glob(path.join(label_folder, '*.png'))):
-        im = plt.imread(im_path)
-        im[im>0] = 1
-        plt.imsave(im_path.replace('label_walls', 'label'), im)
+        label = read_label(im_path)
+        save_label(label > 0, im_path.replace('label_walls', 'label'), bits=1)
 
 if __name__ == '__main__':
     merge_labels()
@@ -7,11 +7,12 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 from config import TILE_SIZE_M, TILE_SIZE_PX
 from core.building_collection import WCBuildingCollection
+from core.projected_buildings import ProjectedBuildings
 from core.image_data import ImageDataList, ImageDataRecord
 from shapely.geometry import Polygon, box
 from PIL import Image
 import cv2
-from utils import get_orthophoto, get_terrain_heights, Camera, ensure_folder_exists, save_image
+from utils import ElevationStore, get_orthophoto, get_terrain_height_lookup, Camera, ensure_folder_exists, save_image
 from utils.enums import SurfaceType
 from rasterio.features import rasterize
 
@@ -30,7 +31,7 @@ Image.MAX_IMAGE_PIXELS = 287944704
 #         return result
 
 
-def prepare_tile(x: int, y:int, cameras, images: list[ImageDataRecord], output_folder: str):
+def prepare_tile(x: int, y:int, cameras, images: ImageDataList, output_folder: str, terrain_heights: dict[tuple, float]):
     tile_name = f'{x}_{y}'
     folder_path = os.path.join(output_folder, tile_name)
     images_folder_path = os.path.join(folder_path, 'images')
@@ -44,8 +45,8 @@ def prepare_tile(x: int, y:int, cameras, images: list[ImageDataRecord], output_f
     r, t = x+TILE_SIZE_M, y+TILE_SIZE_M
     tile_polygon_wc = box(l, b, r, t)
 
-    tile_coords_wo_height = [[l, t], [r, t], [r, b], [l, b]]
-    tile_coords = get_terrain_heights(tile_coords_wo_height)
+    tile_coords_wo_height = [(l, t), (r, t), (r, b), (l, b)]
+    tile_coords = np.array([[x, y, terrain_heights[(x, y)]] for x, y in tile_coords_wo_height])
 
     image_info = {}
 
@@ -53,10 +54,7 @@ def prepare_tile(x: int, y:int, cameras, images: list[ImageDataRecord], output_f
         # Iterate images from one cam at the time. Find the best (most centered) image and export it.
         best_image = None
         best_bbox = (1000000,)
-        for im_data in images:
-            if im_data.cam.cam_id != cam_id: continue
-            if not tile_polygon_wc.intersects(im_data.bbox): continue
-
+        for im_data in images.query(tile_polygon_wc, cam_id):
             xy = im_data.wc_to_ic(tile_coords)
             minx, miny = xy.min(axis=0)
             maxx, maxy = xy.max(axis=0)
@@ -164,7 +162,7 @@ def create_test_area_overview(area, folder, x_bounds, y_bounds):
     # # ax.axis('off')
     # plt.savefig(f'{folder}/test_area.jpeg', bbox_inches='tight')
 
-def create_ground_truth(cityjson, municipality, test_area_polygon, x_bounds, y_bounds):
+def create_ground_truth(cityjson, municipality, test_area_polygon, x_bounds, y_bounds, stream_cityjson=False):
     height = y_bounds[1]-y_bounds[0]-50
     width = x_bounds[1]-x_bounds[0]-50
     # mask = np.zeros((height, width), dtype=np.uint8)
@@ -178,15 +176,9 @@ def create_ground_truth(cityjson, municipality, test_area_polygon, x_bounds, y_b
         # exit()
         return np.array([x,y]).T
     
-    buildings = WCBuildingCollection(cityjson, municipality)
-    buildings_in_area = buildings.get_buildings_in_area(test_area_polygon)
-    for b in buildings_in_area:
-        b.transform_to_image_coordinates(wc_to_ic)
-
-    roof_surfaces = []
-    for building in buildings_in_area:
-        s = building[SurfaceType.ROOF]
-        roof_surfaces.extend(s)
+    buildings = WCBuildingCollection(cityjson, municipality, stream=stream_cityjson)
+    buildings_in_area = ProjectedBuildings(buildings, buildings.get_buildings_in_area(test_area_polygon), wc_to_ic)
+    roof_surfaces = buildings_in_area.get_surfaces(np.arange(len(buildings_in_area)), SurfaceType.ROOF)
 
     mask = rasterize(roof_surfaces, default_value=255, fill=0, out_shape=(height*2, width*2), dtype=np.uint8)
     im = Image.fromarray(mask).save('ground_truth_2.png')
@@ -197,7 +189,8 @@ def create_ground_truth(cityjson, municipality, test_area_polygon, x_bounds, y_b
 
 @click.command()
 @click.argument('config')
-def prepare_analysis(config):
+@click.option('--ground-truth', is_flag=True, help='Only create the ground truth of the test area')
+def prepare_analysis(config, ground_truth):
     with open(config, encoding='utf8') as f:
         config = json.load(f)
 
@@ -208,16 +201,11 @@ def prepare_analysis(config):
     
     image_data_paths = config['image_data']
 
-    image_data_format = config['image_data_format']
-    if image_data_format == 'sos':
-        image_data = ImageDataList.from_sos(image_paths, image_data_paths, cameras)
-    elif image_data_format == 'shp':
-        image_data = ImageDataList.from_shp(image_paths, image_data_paths, cameras)
-    else:
-        raise ValueError(f'"{image_data_format}" is not a valid format. Must be "sos" or "shp"')
+    image_data = ImageDataList.from_files(config['image_data_format'], image_paths, image_data_paths, cameras)
+    # Local DTM tiles, if available. Otherwise the terrain heights are requested from the hoydedata API
+    dtm = ElevationStore(config['dtm'], config.get('elevation_fallback', True)) if 'dtm' in config else None
     
     
-    # Find image_data for images intersecting with the whole test_area
     test_area_coordinates = np.array(config['test_area']['coordinates'][0])
     test_area_polygon = Polygon(test_area_coordinates)
 
@@ -228,11 +216,20 @@ def prepare_analysis(config):
     y_bounds = (miny, maxy+50)
 
     # create_test_area_overview(test_area_polygon, output_folder, x_bounds, y_bounds)
-    create_ground_truth(config['cityjson'], config['municipality'], test_area_polygon, x_bounds, y_bounds)
-    exit()
-
-    images:list[ImageDataRecord] = list(filter(lambda im: test_area_polygon.intersects(im.bbox), image_data))
-
+    if ground_truth:
+        # Large .json exports can be parsed incrementally, see WCBuildingCollection
+        create_ground_truth(config['cityjson'], config['municipality'], test_area_polygon, x_bounds, y_bounds, config.get('stream_cityjson', False))
+        return
+
+    # The terrain heights of all tile corners are sampled at once. Each interior corner is shared by four tiles
+    tile_xs = np.arange(minx, maxx, TILE_SIZE_M)
+    tile_ys = np.arange(miny, maxy, TILE_SIZE_M)
+    if len(tile_xs) == 0 or len(tile_ys) == 0:
+        raise ValueError(f'The test area has no extent ({minx}, {miny}, {maxx}, {maxy}), so it has no tiles to prepare')
+    corner_xs = np.append(tile_xs, tile_xs[-1] + TILE_SIZE_M)
+    corner_ys = np.append(tile_ys, tile_ys[-1] + TILE_SIZE_M)
+    corners = np.stack(np.meshgrid(corner_xs, corner_ys), axis=-1).reshape(-1, 2)
+    terrain_heights = get_terrain_height_lookup(corners, dtm)
 
     with tqdm(total=((maxx-minx)/TILE_SIZE_M) * ((maxy-miny) / TILE_SIZE_M)) as pbar:
         # prepare for each tile...
@@ -242,7 +239,7 @@ def prepare_analysis(config):
             for y in range(miny, maxy, TILE_SIZE_M):
                 if maxy - y < TILE_SIZE_M: print(f'Test area is extended upwards by {maxy-y} meters')
 
-                prepare_tile(x, y, cameras, images, output_folder)
+                prepare_tile(x, y, cameras, image_data, output_folder, terrain_heights)
                 pbar.update(1)
 
 
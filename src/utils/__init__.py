@@ -1,15 +1,24 @@
 from .create_coco_rle_annotation import create_coco_rle_annotation
+from .coco_shards import CocoShardWriter, clear_coco_shards, get_coco_categories, merge_coco_shards
 from .enums import SurfaceType
 from .image_data import get_image_data
 from .camera import Camera
 from .get_municipality_border import get_municipality_border
-from .get_image_bbox import get_image_bbox
-from .get_heights_tiff import get_heights_tiff
+from .get_image_bbox import get_image_bbox, get_image_bboxes
+from .elevation_store import ElevationStore
+from .result_mosaic import ResultMosaic
+from .get_heights_tiff import get_heights_tiff, prefetch_heights_tiffs
 from .convolution import smooth
-from .get_terrain_heights import get_terrain_heights
+from .get_terrain_heights import get_terrain_heights, get_terrain_height_lookup
 from .filter_height_values import filter_height_values
 from .make_histogram import make_histogram
 from .ensure_folder_exists import ensure_folder_exists
 from .nadir_mask import save_corrected_nadir_mask
+from .project_to_ground import project_to_ground
 from .save_image import save_image
-from .get_orthophoto import get_orthophoto
\ No newline at end of file
+from .label_png import read_label, save_label
+from .tile_shards import TileShardReader, TileShardWriter
+from .get_orthophoto import get_orthophoto
+from .ragged_arange import ragged_arange
+from .get_file_hash import get_file_hash
+from .raster_cache import RasterCache, raster_cache
@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+
+from utils.ensure_folder_exists import ensure_folder_exists
+
+
+def get_coco_categories(label_walls: bool) -> list[dict]:
+    if label_walls:
+        return [
+            {"id": 1, "name": "Roof"},
+            {"id": 2, "name": "Wall"},
+            {"id": 3, "name": "Terrace"},
+            {"id": 4, "name": "Terrace wall"},
+            {"id": 5, "name": "Handrail"},
+        ]
+    return [{"id": 1, "name": "Building"}]
+
+
+def get_coco_shard_folder(output_folder: str) -> str:
+    return f'{output_folder}/annotations/shards'
+
+
+def clear_coco_shards(output_folder: str):
+    '''Removes the shards of earlier runs, so merge_coco_shards only merges the shards of this run.'''
+    shutil.rmtree(get_coco_shard_folder(output_folder), ignore_errors=True)
+
+
+class CocoShardWriter():
+    '''
+    Writes the COCO images of one source image to a shard, one JSON line per image with its annotations.
+    The image ids only have to be unique within the shard. The shard is written to a temporary file and
+    moved in place when closed, so an interrupted export never leaves a partial shard to be merged.
+    '''
+    def __init__(self, output_folder: str, name: str):
+        folder = get_coco_shard_folder(output_folder)
+        ensure_folder_exists(folder)
+        self.path = f'{folder}/{name}.jsonl'
+        self._tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        self._file = open(self._tmp_path, 'w', encoding='utf-8')
+
+    def write(self, image_info: dict, annotations: list[dict]):
+        self._file.write(json.dumps({'image': image_info, 'annotations': annotations}) + '\n')
+
+    def close(self):
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmp_path)
+
+
+def _read_shards(shard_paths: list[str]):
+    for path in shard_paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def merge_coco_shards(output_folder: str, label_walls: bool, output_path: str = None) -> tuple[int, int]:
+    '''
+    Merges the shards written by CocoShardWriter into one COCO file, by default annotations/segmentation.json.
+    Clear the shards of earlier runs with clear_coco_shards before exporting.
+    Images and annotations are given consecutive ids in the order of the sorted shard names.
+    The shards are streamed twice, once for the images and once for the annotations, so only one
+    line is kept in memory. Returns the number of images and annotations.
+    '''
+    folder = get_coco_shard_folder(output_folder)
+    # The folder is only created when an image is exported
+    names = os.listdir(folder) if os.path.isdir(folder) else []
+    shard_paths = sorted(os.path.join(folder, name) for name in names if name.endswith('.jsonl'))
+    if output_path is None:
+        output_path = f'{output_folder}/annotations/segmentation.json'
+    ensure_folder_exists(os.path.dirname(output_path))
+    tmp_path = f'{output_path}.tmp'
+
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('{"info": {}, "licenses": [], "categories": ' + json.dumps(get_coco_categories(label_walls)))
+
+        f.write(', "images": [')
+        image_id = 0
+        for record in _read_shards(shard_paths):
+            image_id += 1
+            f.write((', ' if image_id > 1 else '') + json.dumps({**record['image'], 'id': image_id}))
+
+        f.write('], "annotations": [')
+        # The images are read in the same order, so they get the same ids as above
+        image_id = annotation_id = 0
+        for record in _read_shards(shard_paths):
+            image_id += 1
+            for annotation in record['annotations']:
+                annotation_id += 1
+                f.write((', ' if annotation_id > 1 else '') + json.dumps({**annotation, 'image_id': image_id, 'id': annotation_id}))
+        f.write(']}')
+    os.replace(tmp_path, output_path)
+    return image_id, annotation_id
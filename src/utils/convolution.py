@@ -1,5 +1,6 @@
 from timeit import default_timer
 import numpy as np
+from scipy.ndimage import correlate
 
 
 np.set_printoptions(precision=2, suppress=True)
@@ -16,31 +17,61 @@ def create_kernel(kernel_size, sigma):
     return kernel
 
 def smooth(data, data_count, kernel_size=7, sigma=2.5):
+    '''
+    Smooths the data with a Gaussian kernel, where each value is weighted by its count + 1 (normalized convolution).
+    Outside the raster the data is 0 with weight 1. The result has the dtype of the data.
+    '''
+    kernel = create_kernel(kernel_size, sigma)
+    data = np.asarray(data)
+    # Added in the dtype of the counts, as in the original loop
+    weights = (np.asarray(data_count) + 1).astype(np.float64)
+
+    weighted_sum = correlate(data * weights, kernel, mode='constant', cval=0)
+    weight_sum = correlate(weights, kernel, mode='constant', cval=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = weighted_sum / weight_sum
+
+    # Windows where the weights sum to 0 use the kernel as is
+    if weights.min() <= 0:
+        window_weights = correlate(weights, np.ones_like(kernel), mode='constant', cval=1)
+        unweighted = correlate(data.astype(np.float64), kernel, mode='constant', cval=0)
+        result = np.where(window_weights == 0, unweighted, result)
+    return result.astype(data.dtype)
+
+def _smooth_loop(data, data_count, kernel_size=7, sigma=2.5):
+    '''The original implementation, computing one pixel at the time. Used as reference in the benchmark.'''
     kernel = create_kernel(kernel_size, sigma)
     radius = kernel_size//2
     data = np.pad(data, (radius, radius))
     data_count = np.pad(data_count, (radius, radius))
-    # Create an empty output raster
     result = np.zeros_like(data)
-
-    t = default_timer()
-    # Loop over each pixel in the input raster
     for i in range(radius, data.shape[0]-radius):
         for j in range(radius, data.shape[1]-radius):
-            # Calculate the weights for the current pixel based on the neighboring observations
             weights = data_count[i-radius:i+radius+1, j-radius:j+radius+1] + 1
             if weights.sum() == 0:
                 weighted_kernel = kernel
             else:
-                # Calculate weighted kernel
                 weighted_kernel = kernel * weights
-                # Normalize the kernel so that it sums to 1
                 weighted_kernel /= weighted_kernel.sum()
-            # Apply the kernel to the current pixel
             result[i, j] = np.sum(data[i-radius:i+radius+1, j-radius:j+radius+1] * weighted_kernel)
-    result = result[radius:-radius, radius:-radius]
-    print('Process time:', default_timer()-t)
-    return result
+    return result[radius:-radius, radius:-radius]
 
 if __name__ == '__main__':
-    print(create_kernel(9, 3))
\ No newline at end of file
+    print(create_kernel(9, 3))
+
+    # A result raster of a tile, with the number of cameras seeing each pixel as counts
+    from config import RASTER_SIZE
+    rng = np.random.default_rng(0)
+    count = rng.integers(0, 5, (RASTER_SIZE, RASTER_SIZE)).astype(np.uint8)
+    data = rng.random((RASTER_SIZE, RASTER_SIZE)) * count
+
+    t = default_timer()
+    expected = _smooth_loop(data, count)
+    t_loop = default_timer() - t
+
+    t = default_timer()
+    result = smooth(data, count)
+    t_vectorized = default_timer() - t
+
+    assert np.allclose(expected, result, rtol=1e-12, atol=1e-12)
+    print(f'{RASTER_SIZE}x{RASTER_SIZE} raster: loop {t_loop:.2f} s, vectorized {t_vectorized*1000:.1f} ms, max difference {np.abs(expected - result).max():.1e}')
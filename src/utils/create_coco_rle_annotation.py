@@ -2,15 +2,16 @@ import numpy as np
 from pycocotools.mask import encode, area, toBbox
 
 def create_coco_rle_annotation(image_id, category_id, mask):
-    create_coco_rle_annotation.id_counter += 1
+    '''
+    The annotation has no id. Ids are given when the annotations of all images are merged,
+    see merge_coco_shards, so annotations created in different processes never share an id.
+    '''
     rle = encode(np.asfortranarray(mask))
     rle['counts'] = rle['counts'].decode('utf-8')
     return {
         'image_id': image_id,
         'category_id': category_id,
         'segmentation': rle,
-        'id': create_coco_rle_annotation.id_counter,
         'area': int(area(rle)),
         'bbox': toBbox(rle).tolist(),
     }
-create_coco_rle_annotation.id_counter = 0
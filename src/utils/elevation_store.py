@@ -0,0 +1,83 @@
+import os
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.merge import merge
+from rasterio.transform import rowcol
+from rasterio.windows import Window
+import shapely
+from shapely.strtree import STRtree
+
+
+class ElevationStore():
+    '''
+    Elevation rasters (DSM or DTM) read from local files: a directory of GeoTIFF/COG tiles, or a single
+    raster such as a VRT mosaic. The tiles are opened once and found with a search tree over their bounds,
+    and only the windows covering a requested area are read.
+
+    With fallback=True, areas not covered by the tiles are requested from the remote services instead.
+    '''
+    extensions = ('.tif', '.tiff', '.vrt')
+    # Largest window (in pixels) read at once when sampling points. Points spread further apart are sampled one at a time.
+    max_window_size = 4096 * 4096
+
+    def __init__(self, path: str, fallback=True):
+        if os.path.isdir(path):
+            paths = sorted(os.path.join(folder, file) for folder, _, files in os.walk(path) for file in files if file.lower().endswith(self.extensions))
+        else:
+            paths = [path]
+        if len(paths) == 0:
+            raise FileNotFoundError(f'No elevation rasters found in "{path}"')
+        self.path = path
+        self.fallback = fallback
+        self.paths = paths
+        self.datasets = [rasterio.open(p) for p in paths]
+        self.bboxes = shapely.box(*np.array([dataset.bounds for dataset in self.datasets]).T)
+        self.tree = STRtree(self.bboxes)
+        self.crs = self.datasets[0].crs
+
+    def reopen(self):
+        '''Opens the rasters again. Used in forked worker processes, which must not share the open files with the parent.'''
+        self.datasets = [rasterio.open(p) for p in self.paths]
+
+    def _get_datasets(self, bounds) -> list:
+        indices = np.sort(self.tree.query(shapely.box(*bounds)))
+        return [self.datasets[i] for i in indices]
+
+    def covers(self, bounds) -> bool:
+        '''Whether the area is fully inside the tiles, so it can be read without the remote fallback.'''
+        area = shapely.box(*bounds)
+        return shapely.union_all(self.bboxes[self.tree.query(area)]).contains(area)
+
+    def read(self, bounds, width: int, height: int, resampling=Resampling.nearest) -> tuple[np.ndarray, rasterio.Affine]:
+        '''
+        Reads the area (minx, miny, maxx, maxy) resampled to width x height pixels, like a WCS GetCoverage request.
+        Pixels without data are nan.
+        '''
+        minx, miny, maxx, maxy = bounds
+        res = ((maxx - minx) / width, (maxy - miny) / height)
+        heights, transform = merge(self._get_datasets(bounds), bounds=bounds, res=res, nodata=np.nan, dtype='float32', resampling=resampling)
+        return heights[0], transform
+
+    def sample(self, xy: np.ndarray) -> np.ndarray:
+        '''The heights at the (n, 2) coordinates. Points outside the tiles or without data are nan.'''
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        z = np.full(len(xy), np.nan)
+        point_indices, dataset_indices = self.tree.query(shapely.points(xy), predicate='intersects')
+        for dataset_index in np.unique(dataset_indices):
+            dataset = self.datasets[dataset_index]
+            points = point_indices[dataset_indices == dataset_index]
+            points = points[np.isnan(z[points])]
+            rows, cols = (np.asarray(a) for a in rowcol(dataset.transform, xy[points, 0], xy[points, 1]))
+            # Points on the right or bottom edge belong to the next tile
+            inside = (rows >= 0) & (rows < dataset.height) & (cols >= 0) & (cols < dataset.width)
+            points, rows, cols = points[inside], rows[inside], cols[inside]
+            if len(points) == 0: continue
+            window = Window.from_slices((rows.min(), rows.max() + 1), (cols.min(), cols.max() + 1))
+            if window.width * window.height <= self.max_window_size:
+                # One window covering all the points in the tile
+                values = dataset.read(1, window=window, masked=True)[rows - rows.min(), cols - cols.min()]
+            else:
+                values = np.ma.concatenate([value for value in dataset.sample(xy[points], indexes=1, masked=True)])
+            z[points] = np.ma.filled(values.astype(np.float64), np.nan)
+        return z
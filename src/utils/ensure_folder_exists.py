@@ -2,5 +2,6 @@ from os import makedirs, path
 
 def ensure_folder_exists(folder):
     if not path.isdir(folder):
-        makedirs(folder)
+        # exist_ok, as parallel workers may create the same folder concurrently
+        makedirs(folder, exist_ok=True)
 
@@ -0,0 +1,102 @@
+'''
+HTTP requests to the geonorge services, with a pooled client, timeouts and retries with backoff.
+fetch() makes a single blocking request, and fetch_all() makes many requests concurrently with asyncio.
+
+The requests go to the base URL of each service, unless the environment variable GEONORGE_BASE_URL is set,
+which sends all requests to that server instead (e.g. a local stand-in server in tests).
+'''
+import asyncio
+import os
+import random
+import time
+import httpx
+
+base_urls = {
+    'wcs': 'https://wcs.geonorge.no',
+    'wms': 'https://wms.geonorge.no',
+    'ws': 'https://ws.geonorge.no',
+}
+timeout = 60 # Seconds
+retries = 3
+backoff = 0.5 # Seconds before the first retry. Doubled for each retry
+concurrency = 8 # Most requests in flight at once in fetch_all
+
+_client = None
+_client_pid = None
+
+
+def get_url(service: str, path: str) -> str:
+    base_url = os.environ.get('GEONORGE_BASE_URL') or base_urls[service]
+    return base_url.rstrip('/') + path
+
+
+def _should_retry(response: httpx.Response) -> bool:
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def _get_backoff(attempt: int) -> float:
+    return backoff * 2**attempt * (1 + random.random())
+
+
+def _get_client() -> httpx.Client:
+    global _client, _client_pid
+    # Connections are not shared with forked worker processes
+    if _client is None or _client_pid != os.getpid():
+        _client = httpx.Client(timeout=timeout)
+        _client_pid = os.getpid()
+    return _client
+
+
+def fetch(service: str, path: str, params: dict = None) -> bytes:
+    '''Returns the content of a GET request to the path of the service, retrying on server and connection errors.'''
+    url = get_url(service, path)
+    for attempt in range(retries + 1):
+        try:
+            response = _get_client().get(url, params=params)
+            if not _should_retry(response) or attempt == retries:
+                response.raise_for_status()
+                return response.content
+        except httpx.TransportError:
+            if attempt == retries: raise
+        time.sleep(_get_backoff(attempt))
+
+
+async def _fetch_async(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, service: str, path: str, params: dict) -> bytes:
+    url = get_url(service, path)
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                response = await client.get(url, params=params)
+            if not _should_retry(response) or attempt == retries:
+                response.raise_for_status()
+                return response.content
+        except httpx.TransportError:
+            if attempt == retries: raise
+        await asyncio.sleep(_get_backoff(attempt))
+
+
+async def _fetch_all(requests: list[tuple[str, str, dict]], on_content=None, return_exceptions=False) -> list[bytes]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_request(i, request):
+        content = await _fetch_async(client, semaphore, *request)
+        if on_content is not None:
+            on_content(i, content)
+        return content
+
+    async with httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(max_connections=concurrency)) as client:
+        return await asyncio.gather(*(fetch_request(i, request) for i, request in enumerate(requests)), return_exceptions=return_exceptions)
+
+
+def fetch_all(requests: list[tuple[str, str, dict]], on_content=None, return_exceptions=False) -> list[bytes]:
+    '''
+    Makes the (service, path, params) GET requests concurrently, at most `concurrency` at the time,
+    and returns the contents in the same order.
+
+    on_content(i, content) is called as soon as request i completes, e.g. to store the content instead of
+    keeping it until all requests are done. With return_exceptions, the exception of a request that failed
+    after its retries is returned in its place instead of raised, and the other requests are completed.
+    '''
+    if len(requests) == 0:
+        return []
+    return asyncio.run(_fetch_all(requests, on_content, return_exceptions))
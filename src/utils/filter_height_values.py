@@ -1,16 +1,37 @@
 from matplotlib import pyplot as plt
 import numpy as np
 from PIL import Image
+from scipy.spatial import cKDTree
 
 from utils.make_histogram import make_histogram
 
-def filter_height_values(points, mask_w, mask_h, cropbox, cropbox_size):
-    d_z = np.zeros(len(points))
-    neighbour_count = np.zeros(len(points), dtype=np.uint8)
+rtol = 1e-5 # As in np.isclose
+
 
+def _get_neighbour_pairs(xy: np.ndarray, atol: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Returns the indices (i, j) of all pairs where xy[j] is a neighbour of xy[i], i.e. np.isclose(xy[i], xy[j], atol=atol).all().
+    Candidates are found with a KD-tree in coordinates scaled by atol, and then checked exactly like np.isclose does.
+    '''
+    finite = np.flatnonzero(np.isfinite(xy).all(axis=1))
+    if len(finite) == 0:
+        return finite, finite
+    scaled = xy[finite] / atol
+    # The radius also covers the relative tolerance of np.isclose, and rounding of the coordinates
+    r = 1 + rtol * np.abs(scaled).max() + 1e-3
+    pairs = cKDTree(scaled).query_pairs(r, p=np.inf, output_type='ndarray')
+    i = finite[np.concatenate((pairs[:,0], pairs[:,1]))]
+    j = finite[np.concatenate((pairs[:,1], pairs[:,0]))]
+    close = (np.abs(xy[i] - xy[j]) <= atol + rtol * np.abs(xy[j])).all(axis=1)
+    # Every point is its own neighbour
+    return np.concatenate((finite, i[close])), np.concatenate((finite, j[close]))
+
+
+def filter_height_values(points, mask_w, mask_h, cropbox, cropbox_size):
     # Scale neighbourhood size based on mask size, because a more oblique view will contain more points per pixel.
     scale_x = mask_w / 500
     scale_y = mask_h / 500
+    atol = np.array((10*scale_y, 10*scale_x))
 
     # ax = fig.add_subplot(111)
     # plt.close()
@@ -32,16 +53,13 @@ def filter_height_values(points, mask_w, mask_h, cropbox, cropbox_size):
     # plt.axis('off')
     # plt.savefig('height_points.png', bbox_inches='tight')
     # exit()
-    for i, point in enumerate(points):
-        # Find the indices of the neighboring points
-        neighbours = points[np.isclose(point[:2], points[:,:2], atol=(10*scale_y, 10*scale_x)).all(axis=1)]
-        # d_xy = np.linalg.norm(neighbours[:,:2] - point[2], axis=1)
-        # d_y = neighbours[:,0] - point[0]
-        # d_z = neighbours[:,2] - point[2]
-        neighbour_count[i] = len(neighbours)
-        d_z[i] = np.mean(neighbours[:,2] - point[2])
+    # The neighbours of each point are the points within the window around it
+    i, j = _get_neighbour_pairs(points[:,:2], atol)
+    # Stored as uint8 like before, so counts above 255 wrap around
+    neighbour_count = np.bincount(i, minlength=len(points)).astype(np.uint8)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        d_z = np.bincount(i, weights=points[j,2] - points[i,2], minlength=len(points)) / np.bincount(i, minlength=len(points))
 
-        # d_z[i] = (d_z/d_xy).sum()
     # res = points[(neighbour_count <= 5) | (d_z < 0)]
     # make_histogram(d_z, 20, 'gradient')
     # res = points[(d_z < 0)]
@@ -73,3 +91,51 @@ def filter_height_values(points, mask_w, mask_h, cropbox, cropbox_size):
     # color[a] = 'green'
     # color[np.invert(a)] = 'red'
     # color[neighbour_count <= 5] = 'black'
+
+
+def _filter_height_values_loop(points, mask_w, mask_h, cropbox, cropbox_size):
+    '''The original implementation, comparing every point to all other points. Used as reference in the benchmark.'''
+    d_z = np.zeros(len(points))
+    neighbour_count = np.zeros(len(points), dtype=np.uint8)
+    scale_x = mask_w / 500
+    scale_y = mask_h / 500
+    for i, point in enumerate(points):
+        neighbours = points[np.isclose(point[:2], points[:,:2], atol=(10*scale_y, 10*scale_x)).all(axis=1)]
+        neighbour_count[i] = len(neighbours)
+        d_z[i] = np.mean(neighbours[:,2] - point[2])
+    return points[(neighbour_count <= 5) | (d_z < 0)]
+
+
+def _get_test_points(mask_w, mask_h, rng):
+    '''
+    Points like in analyze_tile: the HEIGHT_RASTER_SIZE x HEIGHT_RASTER_SIZE grid of a 70x70 m area projected to a mask
+    of mask_w x mask_h px, with some perspective, on roofs of a few heights, keeping the points on about half of the mask.
+    '''
+    from config import HEIGHT_RASTER_SIZE
+    u, v = np.meshgrid(np.linspace(0, 1, HEIGHT_RASTER_SIZE), np.linspace(0, 1, HEIGHT_RASTER_SIZE))
+    y = (u * (0.9 + 0.2 * v)) * mask_h * 1.4 - mask_h * 0.2
+    x = v * mask_w * 1.4 - mask_w * 0.2
+    z = 30 + 8 * rng.integers(0, 3, u.shape) + 3 * np.abs(u - 0.5) + rng.normal(0, 0.1, u.shape)
+    points = np.stack((y, x, z), axis=-1).reshape(-1, 3).astype(np.float32)
+    on_mask = (points[:,0] >= 0) & (points[:,0] < mask_h) & (points[:,1] >= 0) & (points[:,1] < mask_w)
+    return points[on_mask & (rng.random(len(points)) < 0.5)]
+
+
+if __name__ == '__main__':
+    from timeit import default_timer
+
+    rng = np.random.default_rng(0)
+    for mask_w, mask_h in [(500, 500), (560, 640), (700, 720)]:
+        points = _get_test_points(mask_w, mask_h, rng)
+        cropbox_size = max(mask_w, mask_h)
+
+        t = default_timer()
+        expected = _filter_height_values_loop(points, mask_w, mask_h, None, cropbox_size)
+        t_loop = default_timer() - t
+
+        t = default_timer()
+        result = filter_height_values(points, mask_w, mask_h, None, cropbox_size)
+        t_tree = default_timer() - t
+
+        assert np.array_equal(expected, result)
+        print(f'{mask_w}x{mask_h} mask, {len(points)} points: loop {t_loop:.3f} s, KD-tree {t_tree:.4f} s ({t_loop/t_tree:.0f}x), identical output')
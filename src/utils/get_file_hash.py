@@ -0,0 +1,9 @@
+import hashlib
+
+def get_file_hash(path: str, chunk_size=16*1024*1024) -> str:
+    '''Returns the sha1 hex digest of the content of a file.'''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            sha1.update(chunk)
+    return sha1.hexdigest()
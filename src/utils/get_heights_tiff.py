@@ -3,14 +3,16 @@ import os
 from matplotlib import pyplot as plt
 import numpy as np
 from rasterio import DatasetReader
+from rasterio.io import MemoryFile
 import rasterio
-import requests
 from shapely.geometry import Polygon, box
 from PIL import Image, ImageFilter
 
-from utils.ensure_folder_exists import ensure_folder_exists
+from utils.elevation_store import ElevationStore
+from utils.fetch import fetch, fetch_all
+from utils.raster_cache import RasterCache, raster_cache
 
-url = "https://wcs.geonorge.no/skwms1/wcs.hoyde-dom-nhm-25832"
+path = "/skwms1/wcs.hoyde-dom-nhm-25832"
 coverage = 'nhm_dom_topo_25832'
 srid = 25832
 
@@ -18,13 +20,22 @@ srid = 25832
 
 
 img_format = "GeoTiff"
-def get_heights_tiff(area: Polygon, folder_path=None, tile_size=512) -> DatasetReader:
-    file_name = f'cache/laser_data/heights_{"{:.0f}_{:.0f}".format(*area.centroid.coords[0])}.tiff'
-    if os.path.exists(file_name):
-        return rasterio.open(file_name)
 
-    bounds = area.bounds
-    params = {
+
+def _to_dataset(heights: np.ndarray, transform, crs) -> DatasetReader:
+    with MemoryFile() as memfile:
+        with memfile.open(driver='GTiff', width=heights.shape[1], height=heights.shape[0], count=1,
+                          dtype=heights.dtype, crs=crs, transform=transform) as dataset:
+            dataset.write(heights, 1)
+        return rasterio.open(io.BytesIO(memfile.read()))
+
+
+def _get_cache_key(bounds, tile_size) -> str:
+    return RasterCache.get_key('wcs', coverage, bounds, (tile_size, tile_size), f'EPSG:{srid}', 'tiff')
+
+
+def _get_params(bounds, tile_size) -> dict:
+    return {
         'service': 'wcs',
         'version': '1.0.0',
         'request': 'getCoverage',
@@ -35,15 +46,51 @@ def get_heights_tiff(area: Polygon, folder_path=None, tile_size=512) -> DatasetR
         'crs': f'EPSG:{srid}',
         'bbox': ', '.join((format(x, ".2f") for x in bounds))
     }
-    response = requests.get(url, params=params, stream=True,
-                        headers=None, timeout=None)
-    if response.status_code == 200:
-        ensure_folder_exists(os.path.dirname(file_name))
-        with open(file_name, 'wb') as f:
-            f.write(response.content)
-        return rasterio.open(io.BytesIO(response.content))
-    else:
-        raise requests.HTTPError(f'Request failed with status code {response.status_code}')
+
+
+def _needs_download(bounds, store: ElevationStore) -> bool:
+    if store is not None and store.covers(bounds):
+        return False
+    if store is not None and not store.fallback:
+        raise ValueError(f'The elevation store does not cover the area {bounds}')
+    return True
+
+
+def get_heights_tiff(area: Polygon, folder_path=None, tile_size=512, store: ElevationStore = None) -> DatasetReader:
+    '''
+    Returns the heights in the bbox of the area as a tile_size x tile_size raster. The heights are read from the
+    local elevation store when it covers the bbox. Otherwise they are requested from the WCS, unless the store
+    has no fallback, and the response is kept in the raster cache.
+    '''
+    bounds = area.bounds
+    if not _needs_download(bounds, store):
+        heights, transform = store.read(bounds, tile_size, tile_size)
+        return _to_dataset(heights, transform, store.crs)
+
+    content = raster_cache.fetch(_get_cache_key(bounds, tile_size), lambda: fetch('wcs', path, _get_params(bounds, tile_size)))
+    return rasterio.open(io.BytesIO(content))
+
+
+def prefetch_heights_tiffs(areas: list[Polygon], tile_size=512, store: ElevationStore = None) -> int:
+    '''
+    Downloads the heights of all the areas that are neither covered by the store nor cached, concurrently,
+    so the following calls to get_heights_tiff read them from the cache. Each raster is stored as soon as it
+    is downloaded. Failed downloads are reported and skipped, get_heights_tiff requests them again when needed.
+    Returns the number of failed downloads.
+    '''
+    bounds = []
+    for area in areas:
+        try:
+            if _needs_download(area.bounds, store) and _get_cache_key(area.bounds, tile_size) not in raster_cache:
+                bounds.append(area.bounds)
+        except ValueError:
+            continue # Not covered by the store. Reported by the tile that needs it
+    store_content = lambda i, content: raster_cache.store(_get_cache_key(bounds[i], tile_size), content)
+    results = fetch_all([('wcs', path, _get_params(b, tile_size)) for b in bounds], on_content=store_content, return_exceptions=True)
+    failed = [(b, result) for b, result in zip(bounds, results) if isinstance(result, Exception)]
+    for b, error in failed:
+        print(f'Failed to prefetch the heights of {b}: {error!r}')
+    return len(failed)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 from collections import OrderedDict
 
 import numpy as np
+import shapely
 from shapely.geometry import Polygon
 
 
@@ -9,4 +10,11 @@ def get_image_bbox(image_extent: OrderedDict):
     image_bbox[:, [1, 0]] = image_bbox[:, [0, 1]]
 
     image_bbox /= 100 # Coordinates are given in cm for some reason. Convert to m.
-    return Polygon(image_bbox)
\ No newline at end of file
+    return Polygon(image_bbox)
+
+
+def get_image_bboxes(extent_coordinates: np.ndarray, extent_offsets: np.ndarray) -> np.ndarray:
+    '''The image bboxes of the extents read by libs.sosi.read_seamlines, as an array of polygons.'''
+    xy = extent_coordinates[:, ::-1] / 100 # (N, E) in cm to (x, y) in m
+    indices = np.repeat(np.arange(len(extent_offsets) - 1), np.diff(extent_offsets))
+    return shapely.polygons(shapely.linearrings(xy, indices=indices))
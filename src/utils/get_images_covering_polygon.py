@@ -1,20 +1,17 @@
-import itertools
-
 import numpy as np
-from libs.sosi import read_sos
+from libs.sosi import read_seamlines
 from shapely.strtree import STRtree
 from shapely.geometry import Polygon
 
-from utils import get_image_bbox
+from utils import get_image_bboxes
 
 
 class ImageIndex():
     def __init__(self, seamline_paths: list[str]):
-        seamlines = [list(read_sos(path).values())[1:-1] for path in seamline_paths]
-        self.image_data = np.array(itertools.chain([s[::2] for s in seamlines]))
-        image_extents = [s[1::2] for s in seamlines]
+        seamlines = [read_seamlines(path) for path in seamline_paths]
+        self.image_data = np.concatenate([s['ImageName'] for s in seamlines])
         print('creating polygons')
-        image_bboxes = [get_image_bbox(extent) for extent in itertools.chain(image_extents)]
+        image_bboxes = np.concatenate([get_image_bboxes(s['extent_coordinates'], s['extent_offsets']) for s in seamlines])
         print('creating tree')
         self.tree = STRtree(image_bboxes)
 
@@ -36,4 +33,4 @@ if __name__ == '__main__':
     ]
 
     index = ImageIndex(seamline_paths)
-    index.get_images_covering_polygon()
\ No newline at end of file
+    index.get_images_covering_polygon()
@@ -1,9 +1,9 @@
 import json
 import os
-import urllib
 import shapely.geometry as sg
 
-from utils import ensure_folder_exists
+from utils.ensure_folder_exists import ensure_folder_exists
+from utils.fetch import fetch
 
 
 Municipality = dict(name=str, age=int)
@@ -15,7 +15,7 @@ def get_municipality_border(municipality: Municipality) -> sg.Polygon:
         with open(file_path, encoding='utf8') as f:
             geojson = json.load(f)
     else:
-        response = urllib.request.urlopen(f'https://ws.geonorge.no/kommuneinfo/v1/kommuner/{number}/omrade?utkoordsys=25832', ).read()
+        response = fetch('ws', f'/kommuneinfo/v1/kommuner/{number}/omrade', {'utkoordsys': 25832})
         geojson = json.loads(response)
         ensure_folder_exists('data/municipalities')
         with open(file_path, 'w', encoding='utf8') as f:
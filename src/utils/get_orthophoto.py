@@ -4,38 +4,30 @@ from matplotlib import pyplot as plt
 import numpy as np
 from rasterio import DatasetReader
 import rasterio
-import requests
 from shapely.geometry import Polygon, box
 # from PIL import Image, ImageFilter
 
-from utils import ensure_folder_exists
+from utils.fetch import fetch
+from utils.raster_cache import RasterCache, raster_cache
 
-url = "https://wms.geonorge.no/skwms1/wms.nib"
-
-def get_orthophoto(area: Polygon, height: int, width: int) -> DatasetReader:
-    file_name = f'cache/ortofoto/{"{:.0f}_{:.0f}".format(*area.centroid.coords[0])}.jpeg'
-    if os.path.exists(file_name):
-        return file_name
+path = "/skwms1/wms.nib"
+layer = 'ortofoto'
+crs = 'EPSG:25832'
 
+def get_orthophoto(area: Polygon, height: int, width: int) -> str:
+    '''Returns the path of a height x width jpeg of the orthophoto in the bbox of the area, from the raster cache.'''
     bounds = area.bounds
     params = {
         'request': 'getMap',
         'format': "image/jpeg",
         'width': width,
         'height': height,
-        'crs': 'EPSG:25832',
-        'layers': 'ortofoto',
+        'crs': crs,
+        'layers': layer,
         'bbox': ', '.join((format(x, ".2f") for x in bounds))
     }
-    response = requests.get(url, params=params, stream=True,
-                        headers=None, timeout=None)
-    if response.status_code == 200:
-        ensure_folder_exists(os.path.dirname(file_name))
-        with open(file_name, 'wb') as f:
-            f.write(response.content)
-        return io.BytesIO(response.content)
-    else:
-        raise requests.HTTPError(f'Request failed with status code {response.status_code}')
+    key = RasterCache.get_key('wms', layer, bounds, (width, height), crs, 'jpeg')
+    return raster_cache.fetch_path(key, lambda: fetch('wms', path, params))
 
 
 if __name__ == '__main__':
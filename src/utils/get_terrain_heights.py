@@ -1,20 +1,51 @@
 import json
 import numpy as np
 
-import requests
+from utils.elevation_store import ElevationStore
+from utils.fetch import fetch_all
 
 np.set_printoptions(suppress = True)
 
-url = 'https://ws.geonorge.no/hoydedata/v1/datakilder/dtm1/punkt'
+path = '/hoydedata/v1/datakilder/dtm1/punkt'
 
-def get_terrain_heights(coordinates):
-    params = {
+# Most points the API accepts in one request
+max_points = 50
+
+def _request_terrain_heights(coordinates):
+    # The requests of all chunks are made concurrently
+    contents = fetch_all([('ws', path, {
             'datakilde': 'dtm1',
             'koordsys': 25832,
-            'punkter': json.dumps(coordinates)
-        }
-    response = requests.get(url, params=params, headers=None, timeout=None)
-    return np.array([[p['x'], p['y'], p['z'] if p['z'] is not None else 0] for p in json.loads(response.content)['punkter']])
+            'punkter': json.dumps(coordinates[i:i+max_points])
+        }) for i in range(0, len(coordinates), max_points)])
+    heights = [[p['x'], p['y'], p['z'] if p['z'] is not None else 0] for content in contents for p in json.loads(content)['punkter']]
+    return np.array(heights).reshape(-1, 3)
+
+
+def get_terrain_heights(coordinates, store: ElevationStore = None):
+    '''
+    Returns [x, y, z] of each coordinate, with z = 0 where there is no terrain height. The heights are sampled
+    from the local elevation store (DTM) if given. Points it does not cover are requested from the
+    hoydedata API, unless the store has no fallback.
+    '''
+    if store is None:
+        return _request_terrain_heights(coordinates)
+    xy = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    z = store.sample(xy)
+    missing = np.flatnonzero(np.isnan(z))
+    if store.fallback and len(missing) > 0:
+        z[missing] = _request_terrain_heights(xy[missing].tolist())[:, 2]
+    return np.column_stack((xy, np.nan_to_num(z, nan=0)))
+
+
+def get_terrain_height_lookup(coordinates, store: ElevationStore = None) -> dict[tuple[float, float], float]:
+    '''
+    Gets the terrain heights of many coordinates at once, each distinct coordinate only once, and returns
+    a (x, y) -> z lookup table.
+    '''
+    xy = np.unique(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2), axis=0)
+    heights = get_terrain_heights(xy.tolist(), store)
+    return {(x, y): z for (x, y), z in zip(xy.tolist(), heights[:, 2].tolist())}
 
 
 if __name__ == '__main__':
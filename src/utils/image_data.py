@@ -1,12 +1,12 @@
-
-from libs.sosi import read_sos
+import numpy as np
+from libs.sosi import read_seamlines, SEAMLINE_FIELDS
 
 def get_image_data(seamline_path, image_name):
     print('Reading seamline file:')
-    data = read_sos(seamline_path)
-
-    data_values = data.values()
-    # Search through dict for information about current image
-    image_data = next((x for x in data_values if 'ImageName' in x and x['ImageName'] == image_name), None)
-    return image_data
+    data = read_seamlines(seamline_path)
 
+    # Search through the records for information about current image
+    indices = np.flatnonzero(data['ImageName'] == image_name)
+    if len(indices) == 0:
+        return None
+    return {field: data[field][indices[0]].item() for field in SEAMLINE_FIELDS}
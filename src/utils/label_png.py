@@ -0,0 +1,35 @@
+from PIL import Image
+import numpy as np
+
+# Palette of the label classes: background, roof (or building) and wall
+LABEL_PALETTE = [0, 0, 0, 255, 255, 255, 128, 128, 128, 255, 0, 0]
+
+
+def save_label(mask: np.ndarray, path, bits: int = None, compress_level: int = 9):
+    '''
+    Saves a label mask of class values as a palette PNG with 1 or 2 bits per pixel, so the pixel
+    values are the classes. By default 1 bit is used for masks with classes 0 and 1, and 2 bits otherwise.
+    The images are small, so the highest zlib level costs little time. path can also be a file object.
+    '''
+    mask = np.asarray(mask, dtype=np.uint8)
+    if bits is None:
+        bits = 1 if mask.max(initial=0) <= 1 else 2
+    if mask.max(initial=0) >= 1 << bits:
+        raise ValueError(f'Label values up to {mask.max()} do not fit in {bits} bits')
+    image = Image.frombytes('P', mask.shape[::-1], mask.tobytes())
+    image.putpalette(LABEL_PALETTE[:3 << bits])
+    image.save(path, format='PNG', bits=bits, compress_level=compress_level)
+
+
+def read_label(path) -> np.ndarray:
+    '''
+    Reads a label saved with save_label as a uint8 array of class values.
+    Labels written with plt.imsave and a gray colormap are also read. The colormap scaled the classes to
+    the largest class in the tile, so the gray levels are mapped to their rank (0, 1, 2, ...).
+    '''
+    with Image.open(path) as image:
+        if image.mode in ('P', '1'):
+            return np.asarray(image, dtype=np.uint8)
+        gray = np.asarray(image.convert('L'))
+    _, classes = np.unique(gray, return_inverse=True)
+    return classes.reshape(gray.shape).astype(np.uint8)
@@ -0,0 +1,18 @@
+import numpy as np
+from rasterio.transform import rowcol
+
+
+def project_to_ground(xs, ys, values, transform, shape) -> np.ndarray:
+    '''
+    Returns a raster of the given shape and transform, where each pixel holds the largest of the values of the points
+    (xs, ys) inside it, or 0 if there are none. Points outside the raster are ignored.
+    '''
+    rows, cols = rowcol(transform, xs, ys)
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+
+    grid = np.zeros(shape)
+    np.maximum.at(grid.reshape(-1), np.ravel_multi_index((rows[inside], cols[inside]), shape), values[inside])
+    return grid
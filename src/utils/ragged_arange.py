@@ -0,0 +1,8 @@
+import numpy as np
+
+def ragged_arange(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    '''Returns the concatenation of np.arange(start, end) for each start, end pair.'''
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(ends, dtype=np.int64) - starts
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(counts.sum())
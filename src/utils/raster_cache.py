@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Callable
+
+from utils.ensure_folder_exists import ensure_folder_exists
+
+
+class RasterCache():
+    '''
+    Cache of rasters downloaded from the map services. The files are named by the sha1 of the request
+    (service, layer, bbox, size, crs), so requests differing in any of them never share a file.
+
+    The total size on disk is capped by evicting the least recently used files (by modification time,
+    which is updated on every hit), and the most recently used rasters are also kept in memory.
+    Files are written to a temporary file first, so an interrupted run never leaves a partial raster.
+    '''
+    def __init__(self, folder='cache/rasters', max_size=4 * 1024**3, memory_items=128):
+        self.folder = folder
+        self.max_size = max_size
+        self.memory_items = memory_items
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._size = None # Total size of the files, computed on the first write
+        self.stats = dict(memory_hits=0, disk_hits=0, misses=0, evictions=0)
+
+    @staticmethod
+    def get_key(service: str, layer: str, bbox, size, crs: str, extension: str) -> str:
+        request = json.dumps([service, layer, [format(x, '.2f') for x in bbox], list(size), crs])
+        return f'{hashlib.sha1(request.encode()).hexdigest()}.{extension}'
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], key)
+
+    def __contains__(self, key: str):
+        return key in self._memory or os.path.exists(self.get_path(key))
+
+    def _remember(self, key: str, content: bytes):
+        self._memory[key] = content
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _touch(self, path: str):
+        # The modification time orders the files for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass # Evicted by another process
+
+    def load(self, key: str) -> bytes:
+        '''Returns the cached raster, or None if it is not cached.'''
+        path = self.get_path(key)
+        if key in self._memory:
+            self.stats['memory_hits'] += 1
+            self._memory.move_to_end(key)
+            self._touch(path)
+            return self._memory[key]
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            self._touch(path)
+        except FileNotFoundError:
+            self.stats['misses'] += 1
+            return None
+        self.stats['disk_hits'] += 1
+        self._remember(key, content)
+        return content
+
+    def store(self, key: str, content: bytes) -> str:
+        '''Writes the raster to the cache, and returns its path.'''
+        path = self.get_path(key)
+        ensure_folder_exists(os.path.dirname(path))
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        self._remember(key, content)
+        if self._size is None:
+            self._size = sum(size for _, _, size in self._list_files())
+        else:
+            self._size += len(content)
+        if self._size > self.max_size:
+            self._evict()
+        return path
+
+    def fetch(self, key: str, fetch_content: Callable[[], bytes]) -> bytes:
+        '''Returns the cached raster, or fetches and stores it if it is not cached.'''
+        content = self.load(key)
+        if content is None:
+            content = fetch_content()
+            self.store(key, content)
+        return content
+
+    def fetch_path(self, key: str, fetch_content: Callable[[], bytes]) -> str:
+        '''Like fetch, but returns the path of the cached file.'''
+        path = self.get_path(key)
+        if os.path.exists(path):
+            self.stats['disk_hits'] += 1
+            self._touch(path)
+            return path
+        self.stats['misses'] += 1
+        return self.store(key, fetch_content())
+
+    def _list_files(self) -> list[tuple[float, str, int]]:
+        files = []
+        for folder, _, names in os.walk(self.folder):
+            for name in names:
+                if name.endswith('.tmp'): continue
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue # Evicted by another process
+                files.append((stat.st_mtime, path, stat.st_size))
+        return files
+
+    def _evict(self):
+        # Rescanned, as other processes may write to the same cache
+        files = sorted(self._list_files())
+        self._size = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if self._size <= self.max_size: break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self._memory.pop(os.path.basename(path), None)
+            self._size -= size
+            self.stats['evictions'] += 1
+
+    def take_stats(self) -> dict[str, int]:
+        '''Returns the statistics since the last call, and resets them. Used to add up the statistics of worker processes.'''
+        stats = self.stats
+        self.stats = dict.fromkeys(stats, 0)
+        return stats
+
+    def add_stats(self, stats: dict[str, int]):
+        for name, value in stats.items():
+            self.stats[name] += value
+
+    def __repr__(self):
+        return f'RasterCache({self.folder}: ' + ', '.join(f'{name}={value}' for name, value in self.stats.items()) + ')'
+
+
+# The cache shared by the fetchers
+raster_cache = RasterCache()
@@ -0,0 +1,67 @@
+import json
+import os
+import numpy as np
+from rasterio.transform import from_bounds
+
+from config import PX_P_M, TILE_SIZE_M
+from utils.ensure_folder_exists import ensure_folder_exists
+
+
+class ResultMosaic():
+    '''
+    The float results of all tiles of an analysis in one memory-mapped array of shape (bands, height, width), covering
+    the bounds of the tiles at PX_P_M pixels per meter. Each tile is written to its own window, so forked worker
+    processes can write their tiles to the same mosaic. Tiles that are never written stay 0.
+    '''
+    bands = ('combined', 'nadir')
+
+    def __init__(self, path: str, bounds, mode='r'):
+        self.path = path
+        self.bounds = tuple(bounds)
+        self.array = np.load(path, mmap_mode=mode)
+        self.transform = from_bounds(*self.bounds, self.array.shape[2], self.array.shape[1])
+
+    @staticmethod
+    def get_paths(folder: str) -> tuple[str, str]:
+        return os.path.join(folder, 'mosaic.npy'), os.path.join(folder, 'mosaic.json')
+
+    @classmethod
+    def create(cls, folder: str, tile_xs, tile_ys):
+        '''Creates an empty mosaic in the folder, covering the tiles with the given lower left corners.'''
+        if len(tile_xs) == 0 or len(tile_ys) == 0:
+            raise ValueError(f'No tiles to create the result mosaic in "{folder}" for. Prepare the analysis first')
+        ensure_folder_exists(folder)
+        path, info_path = cls.get_paths(folder)
+        bounds = (min(tile_xs), min(tile_ys), max(tile_xs) + TILE_SIZE_M, max(tile_ys) + TILE_SIZE_M)
+        shape = (len(cls.bands), (bounds[3] - bounds[1]) * PX_P_M, (bounds[2] - bounds[0]) * PX_P_M)
+        # The file is sparse until the tiles are written
+        np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape).flush()
+        with open(info_path, 'w') as f:
+            json.dump({'bounds': bounds, 'bands': cls.bands}, f)
+        return cls(path, bounds, mode='r+')
+
+    @classmethod
+    def open(cls, folder: str, mode='r'):
+        path, info_path = cls.get_paths(folder)
+        if not os.path.exists(info_path):
+            raise FileNotFoundError(f'No result mosaic in "{folder}". Analyze the tiles first')
+        with open(info_path) as f:
+            info = json.load(f)
+        return cls(path, info['bounds'], mode)
+
+    def get_window(self, tile_x: int, tile_y: int) -> tuple[slice, slice]:
+        row = (self.bounds[3] - (tile_y + TILE_SIZE_M)) * PX_P_M
+        col = (tile_x - self.bounds[0]) * PX_P_M
+        return slice(row, row + TILE_SIZE_M * PX_P_M), slice(col, col + TILE_SIZE_M * PX_P_M)
+
+    def write_tile(self, tile_x: int, tile_y: int, **results: np.ndarray):
+        '''Writes the results of the tile, given by band name, e.g. write_tile(x, y, combined=..., nadir=...).'''
+        rows, cols = self.get_window(tile_x, tile_y)
+        for band, result in results.items():
+            self.array[self.bands.index(band), rows, cols] = result
+
+    def get_band(self, band: str) -> np.ndarray:
+        return self.array[self.bands.index(band)]
+
+    def flush(self):
+        self.array.flush()
@@ -0,0 +1,132 @@
+import io
+import os
+import tarfile
+import numpy as np
+from PIL import Image
+
+from utils.ensure_folder_exists import ensure_folder_exists
+from utils.label_png import read_label
+
+# One row per tile. The offsets point to the data of the members in the (uncompressed) tar shards.
+# The position of the camera is included, the rest of the image data is in image_data/<image>.json.
+TILE_INDEX_DTYPE = np.dtype([
+    ('key', 'S96'),
+    ('image', 'S64'),
+    ('shard', np.uint32),
+    ('image_offset', np.uint64),
+    ('image_size', np.uint32),
+    ('label_offset', np.uint64),
+    ('label_size', np.uint32),
+    ('crop_box', np.int32, 4), # Pixel coordinates in the source image (left, upper, right, lower)
+    ('camera_position', np.float64, 3), # Easting, northing and height of the source image
+    ('building_coverage', np.float32),
+])
+
+
+def get_shard_paths(folder: str) -> tuple[str, str]:
+    '''Returns the name pattern of the shards and the path of the index.'''
+    return os.path.join(folder, 'shards', 'tiles-{:05d}.tar'), os.path.join(folder, 'shards', 'index.npy')
+
+
+class TileShardWriter():
+    '''
+    Packs the exported tiles and labels into tar shards of about max_size bytes, WebDataset style: the tile
+    is stored as <key>.jpg and its label as <key>.png. The index of all tiles is written as a npy file when
+    the writer is closed, sorted by key so TileShardReader can memory-map it and look up tiles by key.
+    Only one process should write to a folder. The worker processes of create_dataset return the encoded
+    tiles to the main process, which writes them.
+    '''
+    def __init__(self, folder: str, max_size=1024**3):
+        self.shard_pattern, self.index_path = get_shard_paths(folder)
+        if os.path.exists(self.index_path):
+            raise FileExistsError(f'"{self.index_path}" exists. Shards are not appended to, use a new output folder')
+        ensure_folder_exists(os.path.dirname(self.index_path))
+        self.max_size = max_size
+        self._shard = -1
+        self._tar = None
+        self._rows = []
+
+    def _next_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+        self._shard += 1
+        self._tar = tarfile.open(self.shard_pattern.format(self._shard), 'w', format=tarfile.USTAR_FORMAT)
+
+    def _add(self, name: str, content: bytes) -> int:
+        '''Adds the member, and returns the offset of its data in the shard.'''
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        self._tar.addfile(info, io.BytesIO(content))
+        # The data is padded to whole blocks, and ends where the next member starts
+        return self._tar.offset - -(-len(content) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+    def write(self, key: str, image: bytes, label: bytes, image_name: str, crop_box, camera_position, building_coverage: float):
+        for name, field in ((key, 'key'), (image_name, 'image')):
+            if len(name.encode()) > TILE_INDEX_DTYPE[field].itemsize:
+                raise ValueError(f'"{name}" is too long for the {field} field of the index')
+        if self._tar is None or self._tar.offset > self.max_size:
+            self._next_shard()
+        image_offset = self._add(f'{key}.jpg', image)
+        label_offset = self._add(f'{key}.png', label)
+        self._rows.append((key.encode(), image_name.encode(), self._shard, image_offset, len(image),
+                           label_offset, len(label), crop_box, camera_position, building_coverage))
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+        index = np.array(self._rows, dtype=TILE_INDEX_DTYPE)
+        index.sort(order='key')
+        np.save(self.index_path, index)
+        return len(index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class TileShardReader():
+    '''
+    Random access to the tiles written by TileShardWriter. reader[i] or reader[key] returns the tile image and
+    its label, and reader.index is the memory-mapped index, e.g. to select tiles by image or building coverage.
+    '''
+    def __init__(self, folder: str):
+        self.shard_pattern, index_path = get_shard_paths(folder)
+        self.index = np.load(index_path, mmap_mode='r')
+        self._files = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self) -> list[str]:
+        return [key.decode() for key in self.index['key']]
+
+    def get_position(self, key: str) -> int:
+        key = key.encode()
+        i = np.searchsorted(self.index['key'], key)
+        if i == len(self.index) or self.index['key'][i] != key:
+            raise KeyError(key)
+        return int(i)
+
+    def _read(self, shard: int, offset: int, size: int) -> bytes:
+        # Opened per process, so the reader can be used in the workers of a data loader
+        file_key = (os.getpid(), int(shard))
+        if file_key not in self._files:
+            self._files[file_key] = open(self.shard_pattern.format(shard), 'rb')
+        return os.pread(self._files[file_key].fileno(), int(size), int(offset))
+
+    def read_bytes(self, item) -> tuple[bytes, bytes]:
+        '''Returns the encoded jpg and png of the tile, by position in the index or key.'''
+        row = self.index[self.get_position(item) if isinstance(item, str) else item]
+        return (self._read(row['shard'], row['image_offset'], row['image_size']),
+                self._read(row['shard'], row['label_offset'], row['label_size']))
+
+    def __getitem__(self, item) -> tuple[Image.Image, np.ndarray]:
+        image, label = self.read_bytes(item)
+        return Image.open(io.BytesIO(image)), read_label(io.BytesIO(label))
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}